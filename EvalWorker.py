@@ -0,0 +1,122 @@
+import queue
+import traceback
+
+import torch.multiprocessing as mp
+
+import utils.model_save_util as model_save_util
+from models import struct_loss
+from utils import checkpoint_util, dist_util
+
+
+def eval_loop(opt, image_mode, device, job_queue, result_queue):
+    """
+    evaluation process: runs the Tester pipeline of the trainer on every weights snapshot it receives,
+    and sends the test TMQI back.
+    """
+    if image_mode:
+        import TesterImg as Tester
+    else:
+        import Tester
+    tester = Tester.Tester(device, opt.loss_g_d_factor, opt.ssim_loss_factor, opt)
+    # the snapshot replaces the weights, no init needed
+    netG, netD = model_save_util.create_train_nets(opt, image_mode, device, is_checkpoint=1)
+    ssim_loss = None
+    if opt.ssim_loss_factor:
+        ssim_loss = struct_loss.StructLoss(window_size=opt.ssim_window_size,
+                                           pyramid_weight_list=opt.pyramid_weight_list,
+                                           pyramid_pow=False, use_c3=False, struct_method=opt.struct_method,
+                                           crop_input=opt.add_frame, final_shape_addition=opt.final_shape_addition)
+    while True:
+        job = job_queue.get()
+        if job is None:
+            return
+        epoch, epoch_iter = job["epoch"], job["epoch_iter"]
+        try:
+            # the snapshots are taken from the nets inside the DataParallel / DDP wrappers
+            dist_util.unwrap(netG).load_state_dict(job["netG"])
+            dist_util.unwrap(netD).load_state_dict(job["netD"])
+            if not image_mode:
+                tester.save_test_images(epoch, epoch_iter, opt.output_dir, opt.input_images_mean, netD, netG,
+                                        0, ssim_loss, opt.num_epochs, opt.add_frame)
+            tmqi = tester.save_images_for_model(netG, opt.output_dir, epoch, epoch_iter)
+            result_queue.put({"epoch": epoch, "epoch_iter": epoch_iter, "tmqi": float(tmqi)})
+        except Exception:
+            result_queue.put({"epoch": epoch, "epoch_iter": epoch_iter, "error": traceback.format_exc()})
+
+
+class EvalWorker:
+    """
+    runs the periodic test evaluation in a separate process, so training does not wait for it.
+    submit() sends a cpu copy of the G / D weights, poll() returns the metrics of the finished evaluations.
+    at most max_pending evaluations are queued or running, further snapshots are skipped until one finishes.
+    """
+
+    def __init__(self, opt, image_mode, device=None, max_pending=1):
+        self.opt = opt
+        self.image_mode = image_mode
+        self.device = opt.device if device is None else device
+        self.max_pending = max_pending
+        self.pending = 0
+        self.process = None
+        self.job_queue, self.result_queue = None, None
+
+    def start(self):
+        ctx = mp.get_context("spawn")
+        self.job_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.process = ctx.Process(target=eval_loop, name="eval_worker",
+                                   args=(self.opt, self.image_mode, self.device, self.job_queue, self.result_queue),
+                                   daemon=True)
+        self.process.start()
+
+    def submit(self, epoch, epoch_iter, netG, netD):
+        """
+        :return: False if the snapshot was skipped because max_pending evaluations are still running
+        """
+        if self.pending >= self.max_pending:
+            print("evaluation of epoch %d iter %d skipped, %d evaluation(s) still running"
+                  % (epoch, epoch_iter, self.pending))
+            return False
+        self.job_queue.put({"epoch": epoch, "epoch_iter": epoch_iter,
+                            "netG": checkpoint_util.snapshot_state(dist_util.unwrap(netG).state_dict()),
+                            "netD": checkpoint_util.snapshot_state(dist_util.unwrap(netD).state_dict())})
+        self.pending += 1
+        return True
+
+    def poll(self, wait=False):
+        """
+        :param wait: block until every submitted evaluation is done
+        :return: list of {"epoch", "epoch_iter", "tmqi"} (or "error") of the finished evaluations
+        """
+        results = []
+        while self.pending > 0:
+            try:
+                result = self.result_queue.get(block=wait, timeout=10 if wait else None)
+            except queue.Empty:
+                if wait and self.process.is_alive():
+                    continue
+                if wait:
+                    print("evaluation process exited, %d evaluation(s) lost" % self.pending)
+                    self.pending = 0
+                break
+            self.pending -= 1
+            if "error" in result:
+                print("evaluation of epoch %d iter %d failed:\n%s"
+                      % (result["epoch"], result["epoch_iter"], result["error"]))
+                continue
+            results.append(result)
+        return results
+
+    def close(self):
+        """
+        wait for the running evaluations, stop the process
+        :return: the results not polled yet
+        """
+        results = []
+        if self.process is not None:
+            if self.process.is_alive():
+                results = self.poll(wait=True)
+                self.job_queue.put(None)
+            self.process.join()
+            self.process = None
+        return results
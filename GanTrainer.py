@@ -1,5 +1,7 @@
 from __future__ import print_function
 
+import contextlib
+import math
 import os
 import time
 
@@ -11,50 +13,38 @@ import torch.optim as optim
 import torch.utils.data
 from torch import autograd
 
+import EvalWorker
 import Tester
 import utils.data_loader_util as data_loader_util
 import utils.model_save_util as model_save_util
 import utils.plot_util as plot_util
 from fid import fid_score
 from models import struct_loss
-from utils import printer, params
+from utils import batch_augment, checkpoint_util, dist_util, loss_schedule, metric_buffer, printer, params, \
+    step_profiler
+from models import gaussian_contrast, tmqi_torch
 from einops import rearrange, repeat
-from TMQI import TMQI, TMQIr
 import cv2
 
-def fspecial_gauss(size, sigma, channels):
-    # Function to mimic the 'fspecial' gaussian MATLAB function
-    x, y = np.mgrid[-size//2 + 1:size//2 + 1, -size//2 + 1:size//2 + 1]
-    g = np.exp(-((x**2 + y**2)/(2.0*sigma**2)))
-    g = torch.from_numpy(g/g.sum()).float().unsqueeze(0).unsqueeze(0)
-    return g.repeat(channels,1,1,1)
+def set_requires_grad(net, requires_grad):
+    for param in net.parameters():
+        param.requires_grad = requires_grad
 
-def gaussian_filter(input, win):
-    out = F.conv2d(input, win, stride=1, padding=0, groups=input.shape[1])
-    return out
 
-def compute_contrast(X, win):
-    b, c, h, w = X.shape
-    X_reshape = X.reshape(b*c, 1, h, w)
-    win = win.to(X.device)
+def micro_batch_slices(batch_size, micro_batches):
+    """
+    (start, end) of the micro batches a batch is split into, at most micro_batches of them
+    """
+    size = int(math.ceil(batch_size / micro_batches))
+    return [(start, min(start + size, batch_size)) for start in range(0, batch_size, size)]
 
-    mu1 = gaussian_filter(X_reshape, win)
-    mu1_sq = mu1.pow(2)
-    sigma1_sq = gaussian_filter(X * X, win) - mu1_sq
-    sigma1_sq = sigma1_sq.reshape(b, c, sigma1_sq.shape[2], sigma1_sq.shape[3])
-        
-    return sigma1_sq
 
+def replace_rows(cached, live, start, end):
+    """
+    "cached" (computed without a graph) with its rows [start, end) replaced by "live"
+    """
+    return torch.cat([cached[:start], live, cached[end:]], dim=0)
 
-class ContrastExtracter(torch.nn.Module):
-    def __init__(self, channels=1):
-
-        super(ContrastExtracter, self).__init__()
-        self.win = fspecial_gauss(11, 1.5, 1)
-
-    def forward(self, X):
-        contrast_map = compute_contrast(X, win=self.win)
-        return contrast_map
 
 class GanTrainer:
     def __init__(self, opt, t_netG, t_netD, t_optimizerG, t_optimizerD, lr_scheduler_G, lr_scheduler_D):
@@ -62,6 +52,15 @@ class GanTrainer:
         self.device = opt.device
         self.isCheckpoint = opt.checkpoint
         self.checkpoint = None
+        # checkpoint file or folder (latest checkpoint) to resume from, default <output_dir>/models
+        self.resume_path = opt.resume_path
+        self.resumed = False
+        self.resume_epoch_iter, self.resume_rng_state = 0, None
+        if opt.train_profile not in ["production", "debug"]:
+            raise Exception("unknown train_profile %s, use production/debug" % opt.train_profile)
+        # debug: autograd anomaly detection and per-step G input/output prints
+        self.debug_mode = opt.train_profile == "debug"
+        self.nan_check_every = opt.nan_check_every
 
         # ====== TRAINING ======
         self.batch_size = opt.batch_size
@@ -79,6 +78,21 @@ class GanTrainer:
         self.d_pretrain_epochs = opt.d_pretrain_epochs
         self.pre_train_mode = False
         self.manual_d_training = opt.manual_d_training
+        if opt.micro_batches < 1:
+            raise Exception("micro_batches must be at least 1, got %d" % opt.micro_batches)
+        # the no_grad G_cache forward would update the norm running stats again, and the live micro batches
+        # would be normalised with their own statistics instead of the ones of the whole batch
+        if opt.micro_batches > 1 and opt.unet_norm != "none":
+            raise Exception("micro_batches > 1 needs --unet_norm none, got %s" % opt.unet_norm)
+        self.micro_batches = opt.micro_batches
+        amp_dtypes = {"none": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+        if opt.amp not in amp_dtypes:
+            raise Exception("unknown amp mode %s, use none/bf16/fp16" % opt.amp)
+        self.amp_dtype = amp_dtypes[opt.amp]
+        if self.amp_dtype == torch.float16 and self.device.type != "cuda":
+            raise Exception("fp16 autocast needs cuda, use --amp bf16 on cpu")
+        # loss scaling is only needed by fp16, bf16 has the fp32 exponent range
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.amp_dtype == torch.float16)
 
         # ====== LOSS ======
         self.train_with_D = opt.train_with_D
@@ -95,6 +109,9 @@ class GanTrainer:
                                                       crop_input=opt.add_frame,
                                                       final_shape_addition=opt.final_shape_addition)
 
+        # ranks fakes / fake patches for the pseudo label and infoNCE2 losses, on the train device
+        self.tmqi = tmqi_torch.BatchTMQI().to(self.device)
+        self.contrast_extracter = gaussian_contrast.ContrastExtracter()
         self.loss_g_d_factor = opt.loss_g_d_factor
         self.struct_loss_factor = opt.ssim_loss_factor
         self.errG_d, self.errG_struct, self.errG_intensity, self.errG_mu = None, None, None, None
@@ -102,22 +119,25 @@ class GanTrainer:
         self.accG, self.accD, self.accDreal, self.accDfake = None, None, None, None
         self.accG_counter, self.accDreal_counter, self.accDfake_counter = 0, 0, 0
         self.G_accuracy, self.D_accuracy_real, self.D_accuracy_fake = [], [], []
-        self.G_loss_struct, self.G_loss_d, self.G_loss_intensity = [], [], []
-        self.D_losses, self.D_loss_fake, self.D_loss_real = [], [], []
         self.adv_weight_list = opt.adv_weight_list
         self.strong_details_D_weights = opt.strong_details_D_weights
         self.basic_details_D_weights = opt.basic_details_D_weights
         self.d_weight_mul = 1.0
         self.d_weight_mul_mode = opt.d_weight_mul_mode
-        #self.epoch_step1 = 50
-        self.epoch_step1 = 6
-        self.epoch_step2 = 9
+        self.loss_schedule = loss_schedule.LossSchedule(opt.loss_schedule, opt.loss_schedule_epochs,
+                                                        opt.loss_skip_threshold)
+        print(self.loss_schedule)
 
         # ====== DATASET ======
         #self.train_data_loader_npy, self.train_data_loader_ldr = \
         #    data_loader_util.load_train_data(opt.dataset_properties, title="train")
-        self.train_data_loader_npy, self.train_data_loader_ldr_pos, self.train_data_loader_ldr_neg = \
-            data_loader_util.load_train_data(opt.dataset_properties, title="train")
+        # one loader for the hdr, ldr_pos and ldr_neg batches of each step
+        self.train_data_loader = data_loader_util.load_train_data(opt.dataset_properties, title="train")
+        # full epoch length, also when a resumed epoch skips its first batches
+        self.steps_per_epoch = len(self.train_data_loader)
+        self.batch_augment = None
+        if opt.batch_augment:
+            self.batch_augment = batch_augment.BatchAugment(opt.dataset_properties, self.device)
         self.input_dim = opt.input_dim
         self.input_images_mean = opt.input_images_mean
         self.gamma_log = opt.gamma_log
@@ -133,8 +153,33 @@ class GanTrainer:
         self.output_dir = opt.output_dir
         self.epoch_to_save = opt.epoch_to_save
         self.best_accG = 0
-        self.tester = Tester.Tester(self.device, self.loss_g_d_factor, self.struct_loss_factor,
-                                    opt)
+        self.snapshot_every = opt.snapshot_every
+        self.last_checkpoint_iter = None
+        # opt-in timing of the train step phases, reported to <output_dir>/profile
+        self.profiler = step_profiler.StepProfiler(os.path.join(self.output_dir, "profile"),
+                                                   report_every=opt.profile_every, window=opt.profile_window,
+                                                   sync=bool(opt.profile_sync), trace_start=opt.profile_trace_start,
+                                                   trace_steps=opt.profile_trace_steps, device=self.device,
+                                                   rank=dist_util.get_rank())
+        # when distributed, only rank 0 writes checkpoints and runs the evaluation
+        self.is_main_process = dist_util.is_main_process()
+        self.checkpoint_writer, self.tester, self.eval_worker = None, None, None
+        # the step losses stay on the device and are streamed to <output_dir>/loss_plot (see save_loss_plot)
+        self.metrics = metric_buffer.MetricBuffer(["errD", "errG_d", "errG_struct"], self.device,
+                                                  path=self.get_loss_series_path(pretrain=bool(self.d_pretrain_epochs)),
+                                                  capacity=opt.metrics_buffer_size)
+        if self.is_main_process:
+            # checkpoints are written by a background thread, the last keep_checkpoints and the best by test TMQI are kept
+            self.checkpoint_writer = checkpoint_util.CheckpointWriter(os.path.join(self.output_dir, params.models_save_path),
+                                                                      keep_last=opt.keep_checkpoints, metric_mode="max",
+                                                                      use_thread=bool(opt.async_checkpoint))
+            # the periodic evaluation runs either inline or in a separate process (EvalWorker.py)
+            if opt.eval_worker:
+                self.eval_worker = EvalWorker.EvalWorker(opt, image_mode=False, max_pending=opt.eval_max_pending)
+                self.eval_worker.start()
+            else:
+                self.tester = Tester.Tester(self.device, self.loss_g_d_factor, self.struct_loss_factor,
+                                            opt)
         self.final_epoch = opt.final_epoch
         #self.fid_real_path = opt.fid_real_path
         #self.fid_res_path = opt.fid_res_path
@@ -143,62 +188,110 @@ class GanTrainer:
         printer.print_cuda_details(self.device.type)
         self.verify_checkpoint()
         start_epoch = self.epoch
-        if self.d_pretrain_epochs:
+        if self.d_pretrain_epochs and not self.resumed:
             self.pre_train_mode = True
             print("Starting Discriminator Pre-training Loop...")
             for epoch in range(self.d_pretrain_epochs):
                 self.train_epoch()
                 printer.print_epoch_acc_summary(epoch, self.d_pretrain_epochs, self.accDfake, self.accDreal, self.accG)
-        self.save_loss_plot(self.d_pretrain_epochs, self.output_dir)
-        self.D_losses, self.D_loss_fake, self.D_loss_real = [], [], []
-        self.G_accuracy, self.D_accuracy_real, self.D_accuracy_fake = [], [], []
+        if self.is_main_process:
+            self.save_loss_plot(self.d_pretrain_epochs, self.output_dir)
+        self.metrics.set_path(self.get_loss_series_path())
         self.pre_train_mode = False
-        self.num_iter = 0
+        if self.resumed:
+            # the loss rows of the steps trained after the snapshot are trained again
+            self.metrics.truncate(self.num_iter)
+        else:
+            self.G_accuracy, self.D_accuracy_real, self.D_accuracy_fake = [], [], []
+            self.num_iter = 0
 
         print("\nStarting Training Loop...")
         for epoch in range(start_epoch, self.num_epochs):
             print('epoch:{},iter:{}'.format(epoch,self.num_iter))
             #start = time.time()
             self.epoch += 1
-            self.train_epoch(epoch)
+            # a new shuffle of the composite dataset, the same on every process
+            self.train_data_loader.sampler.set_epoch(epoch)
+            start_iter = 0
+            if self.resume_epoch_iter:
+                # resumed mid-epoch: continue with the batch after the snapshot
+                start_iter, self.resume_epoch_iter = self.resume_epoch_iter, 0
+                self.train_data_loader.sampler.set_start(start_iter * self.batch_size)
+            self.train_epoch(epoch, start_iter)
             self.lr_scheduler_G.step()
             if self.train_with_D:
                 self.lr_scheduler_D.step()
-
-    def train_epoch(self, epoch):
+        if self.eval_worker is not None:
+            self.report_eval_results(self.eval_worker.close())
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+        self.metrics.flush()
+        self.profiler.close()
+
+    def train_epoch(self, epoch, start_iter=0):
         #self.tester.save_images_for_model(self.netG, self.output_dir, epoch, 0)
         self.accG_counter, self.accDreal_counter, self.accDfake_counter = 0, 0, 0
-        epoch_iter=0
-        for (h, data_hdr), (l, data_ldr_pos), (l, data_ldr_neg) in zip(enumerate(self.train_data_loader_npy, 0),
-                                                                       enumerate(self.train_data_loader_ldr_pos, 0),
-                                                                       enumerate(self.train_data_loader_ldr_neg, 0)):
+        epoch_iter=start_iter
+        for data in self.profiler.iterate(self.train_data_loader, "data_fetch"):
+            if self.resume_rng_state is not None:
+                # restored once the loader has drawn its worker seeds, which the interrupted run did at the epoch start
+                checkpoint_util.set_rng_state(self.resume_rng_state, self.device)
+                self.resume_rng_state = None
+            data_hdr, data_ldr_pos, data_ldr_neg = data["hdr"], data["ldr_pos"], data["ldr_neg"]
             self.num_iter += 1
             epoch_iter += 1
             if not self.d_weight_mul_mode == "single":
                 self.d_weight_mul = torch.rand(1).to(self.device)
-            with autograd.detect_anomaly():
-                real_ldr_pos = data_ldr_pos[params.gray_input_image_key].to(self.device)
-                real_ldr_neg = data_ldr_neg[params.gray_input_image_key].to(self.device)
-                hdr_input = self.get_hdr_input(data_hdr)
-                hdr_original_gray_norm = data_hdr[params.original_gray_norm_key].to(self.device)
+            if self.batch_augment is not None:
+                with self.profiler.phase("batch_augment"):
+                    data_hdr = self.batch_augment(data_hdr, hdrMode=True)
+                    data_ldr_pos = self.batch_augment(data_ldr_pos, hdrMode=False)
+                    data_ldr_neg = self.batch_augment(data_ldr_neg, hdrMode=False)
+            with autograd.set_detect_anomaly(self.debug_mode):
+                with self.profiler.phase("h2d_copy"):
+                    real_ldr_pos = data_ldr_pos[params.gray_input_image_key].to(self.device, non_blocking=True)
+                    real_ldr_neg = data_ldr_neg[params.gray_input_image_key].to(self.device, non_blocking=True)
+                    hdr_input = self.get_hdr_input(data_hdr)
+                    hdr_original_gray_norm = data_hdr[params.original_gray_norm_key].to(self.device, non_blocking=True)
                 if self.train_with_D:
                     self.train_D(hdr_input, real_ldr_pos, real_ldr_neg, epoch)
                     #if epoch<=4:
                     #    self.train_D(hdr_input, real_ldr, epoch)
                 if not self.pre_train_mode:
                     self.train_G(hdr_input, hdr_original_gray_norm, real_ldr_pos, real_ldr_neg, epoch)
+                self.scaler.update()
+            if self.nan_check_every and self.num_iter % self.nan_check_every == 0:
+                self.check_losses_finite(epoch)
+            self.metrics.step(self.num_iter)
+            self.profiler.step()
             #print('dataset length:{}'.format(len(self.train_data_loader_npy)))
             #print(epoch_iter)
-            #if epoch_iter % ((len(self.train_data_loader_npy))//4) == 0:
+            #if epoch_iter % ((self.steps_per_epoch)//4) == 0:
             #    self.print_epoch_summary(epoch, epoch_iter)
             if epoch<4 or epoch>7:
-                if epoch_iter % ((len(self.train_data_loader_npy))//4) == 0:
+                if epoch_iter % ((self.steps_per_epoch)//4) == 0:
                     self.print_epoch_summary(epoch, epoch_iter)
             else:
-                if epoch_iter % ((len(self.train_data_loader_npy))//8) == 0:
+                if epoch_iter % ((self.steps_per_epoch)//8) == 0:
                     self.print_epoch_summary(epoch, epoch_iter)
+            if self.snapshot_every and self.num_iter % self.snapshot_every == 0 and self.is_main_process:
+                self.save_checkpoint(epoch, epoch_iter)
         #self.update_accuracy()
 
+    def check_losses_finite(self, epoch):
+        """
+        NaN watchdog, only looks at the scalar losses of the last step (a single device sync).
+        """
+        losses = {"errD": self.errD, "errG_d": self.errG_d, "errG_struct": self.errG_struct}
+        losses = {name: loss for name, loss in losses.items() if torch.is_tensor(loss)}
+        if not losses:
+            return
+        finite = torch.isfinite(torch.stack([loss.detach().float() for loss in losses.values()]))
+        if not bool(finite.all()):
+            bad = [name for name, ok in zip(losses.keys(), finite.tolist()) if not ok]
+            raise Exception("non finite loss %s at epoch %d iteration %d, rerun with --train_profile debug "
+                            "to find the op" % (", ".join(bad), epoch, self.num_iter))
+
     def train_D(self, hdr_input, real_ldr_pos, real_ldr_neg, epoch):
         """
         Update D network
@@ -213,8 +306,9 @@ class GanTrainer:
         # Add the gradients from the all-real and all-fake batches
         #self.errD = self.errD_real + self.errD_fake
         # Update D
-        self.optimizerD.step()
-        self.D_losses.append(self.errD.item())
+        with self.profiler.phase("D_step"):
+            self.scaler.step(self.optimizerD)
+        self.metrics.update("errD", self.errD)
         #self.D_loss_fake.append(self.errD_fake.item())
         #self.D_loss_real.append(self.errD_real.item())
 
@@ -235,11 +329,30 @@ class GanTrainer:
         Forward pass real batch through D
         """
         #print(real_ldr.shape)
-        d_real_pos, _ = self.netD(real_ldr_pos.reshape(-1,real_ldr_pos.shape[2],real_ldr_pos.shape[3],real_ldr_pos.shape[4]))
-        d_real_neg, _ = self.netD(real_ldr_neg.reshape(-1,real_ldr_neg.shape[2],real_ldr_neg.shape[3],real_ldr_neg.shape[4]))
+        if self.micro_batches > 1:
+            self.D_micro_batch_pass(real_ldr_pos, hdr_input, epoch)
+            return
+        with self.profiler.phase("D_forward"), self.autocast():
+            self.D_forward_loss(real_ldr_pos, hdr_input, epoch)
+        with self.profiler.phase("D_backward"):
+            self.scaler.scale(self.errD).backward()
+
+    def D_forward_loss(self, real_ldr_pos, hdr_input, epoch):
+        real, fake = self.D_inputs(real_ldr_pos, hdr_input)
+        # Classify the real and the fake batch with one D call
+        (d_real_pos, _), (d_fake, _) = self.fused_netD([real, fake])
+        self.D_loss(d_real_pos, d_fake, epoch)
+
+    def D_inputs(self, real_ldr_pos, hdr_input):
+        """
+        :return: the real and the (detached) fake batches of the D step, frames flattened
+        """
         # Generate fake image batch with G
         if not self.pre_train_mode:
-            fake, _ = self.netG(hdr_input, diffY=self.final_shape_addition, diffX=self.final_shape_addition)
+            # D only sees the detached fake, so no G graph is built
+            # (DDP also expects a backward after every forward that builds one)
+            with torch.no_grad(), self.profiler.phase("G_forward_for_D"):
+                fake, _ = self.netG(hdr_input, diffY=self.final_shape_addition, diffX=self.final_shape_addition)
             fake = fake.reshape(-1,fake.shape[2],fake.shape[3],fake.shape[4])
         else:
             fake = hdr_input
@@ -247,18 +360,66 @@ class GanTrainer:
             if self.to_crop:
                 fake = data_loader_util.crop_input_hdr_batch(hdr_input, self.final_shape_addition,
                                                              self.final_shape_addition)
-        # Classify all fake batch with D
-        d_fake, _ = self.netD(fake.detach())
+        real = real_ldr_pos.reshape(-1,real_ldr_pos.shape[2],real_ldr_pos.shape[3],real_ldr_pos.shape[4])
+        fake = fake.detach()
+        return real, fake
+
+    def D_loss(self, d_real_pos, d_fake, epoch):
         '''#old best
         if epoch<=5:
             self.errD = self.adv_weight_list[0].float() * self.contrastive_D_loss(d_real, d_fake)
         else:
             self.errD = self.adv_weight_list[0].float() * 1e-6 * self.contrastive_D_loss(d_real, d_fake)'''
-        if epoch<=self.epoch_step1:
-            self.errD = self.adv_weight_list[0].float() * self.contrastive_D_loss(d_real_pos, d_fake) # ContrastiveGAN
-        else:
-            self.errD = self.adv_weight_list[0].float() * 1e-6 * self.contrastive_D_loss(d_real_pos, d_fake)
-        self.errD.backward()
+        # D follows the weight of the G contrastive term, it is never skipped (D needs a loss to step)
+        d_weight = self.loss_schedule.get_weight("contrastive_d", epoch)
+        self.errD = self.adv_weight_list[0].float() * d_weight * self.contrastive_D_loss(d_real_pos, d_fake) # ContrastiveGAN
+
+    def D_micro_batch_pass(self, real_ldr_pos, hdr_input, epoch):
+        """
+        D forward / backward with the gradients accumulated over micro_batches chunks of the batch.
+        contrastive_D_loss compares every real with every fake of the batch: the logits of the whole batch are
+        computed once without a graph and every chunk replaces its rows by its live logits, so the accumulated
+        gradient is the one of the whole batch while only the D graph of one chunk is kept.
+        """
+        with self.profiler.phase("D_forward"), self.autocast():
+            real, fake = self.D_inputs(real_ldr_pos, hdr_input)
+            with torch.no_grad():
+                (d_real_pos_all, _), (d_fake_all, _) = self.fused_netD([real, fake])
+        slices = micro_batch_slices(real.shape[0], self.micro_batches)
+        for i, (start, end) in enumerate(slices):
+            with self.accumulation_context(self.netD, last=i == len(slices) - 1):
+                with self.profiler.phase("D_forward"), self.autocast():
+                    (d_real_pos, _), (d_fake, _) = self.fused_netD([real[start:end], fake[start:end]])
+                    self.D_loss(replace_rows(d_real_pos_all, d_real_pos, start, end),
+                                replace_rows(d_fake_all, d_fake, start, end), epoch)
+                with self.profiler.phase("D_backward"):
+                    self.scaler.scale(self.errD).backward()
+
+    def accumulation_context(self, net, last):
+        """
+        with micro batches, DDP all-reduces the accumulated gradients of "net" only in the backward of the last one
+        """
+        return contextlib.nullcontext() if last else dist_util.no_sync(net)
+
+    def autocast(self):
+        """
+        autocast region of the forward passes, a no-op unless --amp is set.
+        the G losses are computed outside of it in fp32, the D loss is a cross entropy, which autocast keeps in fp32.
+        """
+        return torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None)
+
+    def fused_netD(self, inputs):
+        """
+        classify a list of batches with a single netD call on their concatenation.
+        SimpleDiscriminator has no batch statistics, so this is the same as one call per batch.
+        batches of another shape (the 2 channel input of manual_d_training) get their own call.
+        :return: [(logits, features)] in the order of "inputs"
+        """
+        if any(x.shape[1:] != inputs[0].shape[1:] for x in inputs):
+            return [self.netD(x) for x in inputs]
+        sizes = [x.shape[0] for x in inputs]
+        output, fea = self.netD(torch.cat(inputs, dim=0))
+        return list(zip(output.split(sizes), fea.split(sizes)))
 
     def train_G(self, hdr_input, hdr_original_gray_norm, real_ldr_pos, real_ldr_neg, epoch):
         """
@@ -267,19 +428,72 @@ class GanTrainer:
         :param hdr_original_gray_norm: HDR input (without pre-process) for post-process.
         """
         self.netG.zero_grad()
-        # Since we just updated D, perform another forward pass of all-fake batch through D
-        printer.print_g_progress(hdr_input, "hdr_inp")
-        fake, fea_fake = self.netG(hdr_input.float(), diffY=self.final_shape_addition, diffX=self.final_shape_addition)
-        fea_fake = fea_fake.reshape(-1,fea_fake.shape[2],fea_fake.shape[3],fea_fake.shape[4])
-        fake = fake.reshape(-1,fake.shape[2],fake.shape[3],fake.shape[4])
-        printer.print_g_progress(fake, "output")
+        if self.debug_mode:
+            printer.print_g_progress(hdr_input, "hdr_inp")
+        cache, slices = None, [(0, hdr_input.shape[0])]
+        if self.micro_batches > 1:
+            cache = self.G_cache(hdr_input, real_ldr_pos, real_ldr_neg)
+            slices = micro_batch_slices(hdr_input.shape[0], self.micro_batches)
+        for i, (start, end) in enumerate(slices):
+            with self.accumulation_context(self.netG, last=i == len(slices) - 1):
+                self.G_pass(hdr_input, hdr_original_gray_norm, real_ldr_pos, real_ldr_neg, epoch, cache, start, end)
+        with self.profiler.phase("G_step"):
+            self.scaler.step(self.optimizerG)
+
+    def G_cache(self, hdr_input, real_ldr_pos, real_ldr_neg):
+        """
+        G / D outputs of the whole batch computed without a graph, the fixed rows of the micro batch losses.
+        the DropPath masks of the GCN blocks drawn here are not the ones of the live micro batch forwards
+        (restoring the rng would not help, the masks are drawn per forward for its own batch size).
+        """
+        with torch.no_grad(), self.profiler.phase("G_cache"), self.autocast():
+            fake, fea_fake = self.G_forward(hdr_input)
+            cache = {"fake": fake, "fea_fake": fea_fake}
+            if self.train_with_D:
+                cache["d_fake"], cache["d_fea_fake"] = self.netD(fake.float())
+                cache["d_real"] = self.D_real_outputs(
+                    real_ldr_pos.reshape(-1,real_ldr_pos.shape[2],real_ldr_pos.shape[3],real_ldr_pos.shape[4]), real_ldr_neg.reshape(-1,real_ldr_neg.shape[2],real_ldr_neg.shape[3],real_ldr_neg.shape[4]),
+                    hdr_input.float().reshape(-1,hdr_input.shape[2],hdr_input.shape[3],hdr_input.shape[4]))
+        return cache
+
+    def G_pass(self, hdr_input, hdr_original_gray_norm, real_ldr_pos, real_ldr_neg, epoch, cache, start, end):
+        """
+        G forward, losses and backward of the clips [start, end) of the batch.
+        with micro batches, "cache" holds the outputs of the whole batch (G_cache): the losses, some of which
+        compare the samples of the batch with each other (contrastive_D_loss, the TMQI ranked nce2 and pseudo_label),
+        are computed on the whole batch with the rows of this micro batch replaced by their live outputs.
+        the accumulated gradients approximate the ones of the whole batch: they are exact without stochastic
+        layers, but G has DropPath, so each micro batch loss mixes the live masks with the ones of G_cache.
+        """
+        frames = hdr_input.shape[1]
+        row_start, row_end = start * frames, end * frames
+        with self.profiler.phase("G_forward"), self.autocast():
+            fake, fea_fake = self.G_forward(hdr_input[start:end])
+        if self.debug_mode:
+            printer.print_g_progress(fake.float(), "output")
         if self.train_with_D:
-            d_fake_bp, d_fea_fake = self.netD(fake.float())
-            d_real_pos_bp, d_fea_real_pos = self.netD(real_ldr_pos.reshape(-1,real_ldr_pos.shape[2],real_ldr_pos.shape[3],real_ldr_pos.shape[4]))
-            d_real_neg_bp, d_fea_real_neg = self.netD(real_ldr_neg.reshape(-1,real_ldr_neg.shape[2],real_ldr_neg.shape[3],real_ldr_neg.shape[4]))
-            _, d_fea_input = self.netD(hdr_input.float().reshape(-1,hdr_input.shape[2],hdr_input.shape[3],hdr_input.shape[4]))
+            # D is not trained here: its weights are frozen, and the real / input logits and features,
+            # which G gets no gradient from, are computed without a graph in one D call.
+            # no_sync: the G backward goes through D but leaves no D gradient to all-reduce
+            set_requires_grad(self.netD, False)
+            with self.profiler.phase("D_forward_for_G"), self.autocast(), dist_util.no_sync(self.netD):
+                d_fake_bp, d_fea_fake = self.netD(fake.float())
+                if cache is None:
+                    d_real = self.D_real_outputs(
+                        real_ldr_pos.reshape(-1,real_ldr_pos.shape[2],real_ldr_pos.shape[3],real_ldr_pos.shape[4]), real_ldr_neg.reshape(-1,real_ldr_neg.shape[2],real_ldr_neg.shape[3],real_ldr_neg.shape[4]),
+                        hdr_input.float().reshape(-1,hdr_input.shape[2],hdr_input.shape[3],hdr_input.shape[4]))
+            if cache is not None:
+                d_real = cache["d_real"]
+                fake, fea_fake, d_fake_bp, d_fea_fake = [
+                    replace_rows(cache[key], live, row_start, row_end)
+                    for key, live in (("fake", fake), ("fea_fake", fea_fake), ("d_fake", d_fake_bp),
+                                      ("d_fea_fake", d_fea_fake))]
+            (d_real_pos_bp, d_fea_real_pos), (d_real_neg_bp, d_fea_real_neg), (_, d_fea_input) = d_real
             self.update_g_d_loss(d_fake_bp, d_real_pos_bp, d_real_neg_bp, d_fea_fake, d_fea_real_pos, d_fea_real_neg, d_fea_input, fea_fake, fake, hdr_input.float().reshape(-1,hdr_input.shape[2],hdr_input.shape[3],hdr_input.shape[4]),
                                  real_ldr_pos.reshape(-1,real_ldr_pos.shape[2],real_ldr_pos.shape[3],real_ldr_pos.shape[4]), real_ldr_neg.reshape(-1,real_ldr_neg.shape[2],real_ldr_neg.shape[3],real_ldr_neg.shape[4]), epoch)
+            set_requires_grad(self.netD, True)
+        elif cache is not None:
+            fake = replace_rows(cache["fake"], fake, row_start, row_end)
 
         if self.manual_d_training:
             hdr_input = hdr_input.reshape(-1,hdr_input.shape[2],hdr_input.shape[3],hdr_input.shape[4])
@@ -288,83 +502,89 @@ class GanTrainer:
             hdr_input = hdr_input.reshape(-1,hdr_input.shape[2],hdr_input.shape[3],hdr_input.shape[4])
         hdr_original_gray_norm = hdr_original_gray_norm.reshape(-1,hdr_original_gray_norm.shape[2],hdr_original_gray_norm.shape[3],hdr_original_gray_norm.shape[4])
         self.update_struct_loss(hdr_input, hdr_original_gray_norm, fake)
-        self.optimizerG.step()
+        # a single backward of the summed G losses, DDP all-reduces the G gradients once per step
+        errG = [loss for loss in (self.errG_d, self.errG_struct) if torch.is_tensor(loss) and loss.requires_grad]
+        if errG:
+            with self.profiler.phase("G_backward"):
+                self.scaler.scale(sum(errG)).backward()
+
+    def D_real_outputs(self, real_ldr_pos, real_ldr_neg, hdr_input):
+        """
+        D logits and features of the real pos / neg and the input batches, one D call without a graph
+        """
+        with torch.no_grad():
+            return self.fused_netD([real_ldr_pos, real_ldr_neg, hdr_input])
+
+    def G_forward(self, hdr_input):
+        """
+        :return: fake frames and G features, the clips flattened to (batch * frames)
+        """
+        fake, fea_fake = self.netG(hdr_input.float(), diffY=self.final_shape_addition, diffX=self.final_shape_addition)
+        fea_fake = fea_fake.reshape(-1,fea_fake.shape[2],fea_fake.shape[3],fea_fake.shape[4])
+        fake = fake.reshape(-1,fake.shape[2],fake.shape[3],fake.shape[4])
+        return fake, fea_fake
 
     def get_hdr_input(self, data_hdr):
-        hdr_input = data_hdr[params.gray_input_image_key]
+        hdr_input = data_hdr[params.gray_input_image_key].to(self.device, non_blocking=True)
         if self.manual_d_training and not self.pre_train_mode:
             weight_channel = torch.full(hdr_input.shape, self.d_weight_mul[0]).type_as(hdr_input)
             #hdr_input = torch.cat([hdr_input, weight_channel], dim=1)
             hdr_input = torch.cat([hdr_input, weight_channel], dim=2)
-        return hdr_input.to(self.device)
+        return hdr_input
 
     def update_g_d_loss(self, d_fake_bp, d_real_pos_bp, d_real_neg_bp, d_fea_fake, d_fea_real_pos, d_fea_real_neg, d_fea_input, fea_fake, fake, hdr_input, ldr_pos, ldr_neg, epoch):
-        if epoch<=self.epoch_step1:
-            self.errG_d = self.loss_g_d_factor * self.contrastive_D_loss(d_fake_bp, d_real_pos_bp)
-            self.errG_d += self.loss_g_d_factor * 0.5 * self.infoNCE(d_fea_fake, d_fea_real_pos, d_fea_input, fake, hdr_input, cl_loss_type='InfoNCE', k=1, constant=1e-2)
-            self.errG_d += self.loss_g_d_factor * 0.5 * (0.2 * self.infoNCE(d_fea_fake, d_fea_real_pos, d_fea_real_neg, fake, hdr_input, cl_loss_type='InfoNCE', k=1e3, constant=2))
-            self.errG_d += self.loss_g_d_factor * 1e-6 * self.infoNCE2(fea_fake, fake, hdr_input, cl_loss_type='InfoNCE', k=1, constant=1e-2)
-            l1_loss = nn.L1Loss()
-            self.errG_d += self.loss_g_d_factor * 1e-6 * l1_loss(fake.mean(dim=[-1, -2]), ldr_pos.mean(dim=[-1, -2]))
-            contrast_extracter = ContrastExtracter()
-            fake_contrast = contrast_extracter(fake)
-            ldr_contrast = contrast_extracter(ldr_pos)
-            self.errG_d += self.loss_g_d_factor * 1e-6 * l1_loss(fake_contrast.mean(dim=[-1, -2]), ldr_contrast.mean(dim=[-1, -2]))
-            self.errG_d += self.loss_g_d_factor * 1e-6 * self.pseudo_label_loss(fake, hdr_input)
-        elif epoch<=self.epoch_step2:
-            self.errG_d = self.loss_g_d_factor * 1e-6 *  self.contrastive_D_loss(d_fake_bp, d_real_pos_bp)
-            self.errG_d += self.loss_g_d_factor * 0.5 * self.infoNCE(d_fea_fake, d_fea_real_pos, d_fea_input, fake, hdr_input, cl_loss_type='InfoNCE', k=1, constant=1e-2)
-            self.errG_d += self.loss_g_d_factor * 0.5 * (0.2 * self.infoNCE(d_fea_fake, d_fea_real_pos, d_fea_real_neg, fake, hdr_input, cl_loss_type='InfoNCE', k=1e3, constant=2))
-            self.errG_d += self.loss_g_d_factor * 0.1 * (5 * self.infoNCE2(fea_fake, fake, hdr_input, cl_loss_type='InfoNCE', k=1, constant=1e-2))
-            l1_loss = nn.L1Loss()
-            self.errG_d += self.loss_g_d_factor * 0.5 * (1e2 * l1_loss(fake.mean(dim=[-1, -2]), ldr_pos.mean(dim=[-1, -2])))
-            contrast_extracter = ContrastExtracter()
-            fake_contrast = contrast_extracter(fake)
-            ldr_contrast = contrast_extracter(ldr_pos)
-            self.errG_d += self.loss_g_d_factor * 0.5 * (2 * l1_loss(fake_contrast.mean(dim=[-1, -2]), ldr_contrast.mean(dim=[-1, -2])))
-            self.errG_d += self.loss_g_d_factor * 1e-6 * self.pseudo_label_loss(fake, hdr_input)
-        else:
-            self.errG_d = self.loss_g_d_factor * 1e-6 *  self.contrastive_D_loss(d_fake_bp, d_real_pos_bp)
-            l1_loss = nn.L1Loss()
-            self.errG_d += self.loss_g_d_factor * 0.5 * (1e2 * l1_loss(fake.mean(dim=[-1, -2]), ldr_pos.mean(dim=[-1, -2])))
-            self.errG_d += self.loss_g_d_factor * 0.5 * (1e2 * self.pseudo_label_loss(fake, hdr_input))
-            tv_loss = L_TV()
-            self.errG_d += self.loss_g_d_factor * 0.2 * (1e5 * tv_loss(fake))
-        
-        retain_graph = False
-        if self.struct_loss_factor:
-            retain_graph = True
-        self.errG_d.backward(retain_graph=retain_graph)
-        self.G_loss_d.append(self.errG_d.item())
+        """
+        weighted sum of the terms of the loss schedule that are active at "epoch",
+        the skipped terms (weight below loss_skip_threshold) are not evaluated.
+        the backward of errG_d is done by train_G, together with the structural loss.
+        """
+        # under autocast the G / D outputs are half precision, the losses use fp32 copies
+        d_fake_bp, d_real_pos_bp, d_real_neg_bp, d_fea_fake, d_fea_real_pos, d_fea_real_neg, d_fea_input, fea_fake, fake = \
+            [t.float() for t in (d_fake_bp, d_real_pos_bp, d_real_neg_bp, d_fea_fake, d_fea_real_pos, d_fea_real_neg,
+                                 d_fea_input, fea_fake, fake)]
+        l1_loss = nn.L1Loss()
+        contrast_extracter = self.contrast_extracter
+        loss_terms = {
+            "contrastive_d": lambda: self.contrastive_D_loss(d_fake_bp, d_real_pos_bp),
+            "nce_input": lambda: self.infoNCE(d_fea_fake, d_fea_real_pos, d_fea_input, fake, hdr_input, cl_loss_type='InfoNCE', k=1, constant=1e-2),
+            "nce_neg": lambda: self.infoNCE(d_fea_fake, d_fea_real_pos, d_fea_real_neg, fake, hdr_input, cl_loss_type='InfoNCE', k=1e3, constant=2),
+            "nce2": lambda: self.infoNCE2(fea_fake, fake, hdr_input, cl_loss_type='InfoNCE', k=1, constant=1e-2),
+            "mean_l1": lambda: l1_loss(fake.mean(dim=[-1, -2]), ldr_pos.mean(dim=[-1, -2])),
+            "contrast_l1": lambda: l1_loss(contrast_extracter(fake).mean(dim=[-1, -2]),
+                                           contrast_extracter(ldr_pos).mean(dim=[-1, -2])),
+            "pseudo_label": lambda: self.pseudo_label_loss(fake, hdr_input),
+            "tv": lambda: L_TV()(fake),
+        }
+        self.errG_d = None
+        for term, weight in self.loss_schedule.get_active_terms(epoch):
+            with self.profiler.phase("loss_" + term):
+                term_loss = self.loss_g_d_factor * weight * loss_terms[term]()
+            self.errG_d = term_loss if self.errG_d is None else self.errG_d + term_loss
+        if self.errG_d is None:
+            # every term is skipped in this phase
+            self.errG_d = torch.zeros((), device=fake.device)
+            self.metrics.update("errG_d", 0.)
+            return
+
+        self.metrics.update("errG_d", self.errG_d)
 
     def pseudo_label_loss(self, fake, hdr_input):
-        fake_imgs = fake.permute(0,2,3,1).detach().cpu().numpy()
-        hdr_inputs = hdr_input.permute(0,2,3,1).detach().cpu().numpy()
         #split = 4 # base
         split = 2 
         ps = 256//split
-        patches = []
-        tmqi = TMQI()
-        tmqi_n_scores = []
-        for i in range(fake.shape[0]):
-            for j in range(split):
-                for k in range(split):
-                    hdr_patch =  hdr_inputs[i,j*ps:(j+1)*ps,k*ps:(k+1)*ps,0]
-                    fake_patch = fake_imgs[i,j*ps:(j+1)*ps,k*ps:(k+1)*ps,0]
-                    tmqi_score, tmqi_s_score, tmqi_n_score, _, _ = tmqi(hdr_patch, fake_patch*255)
-                    tmqi_n_scores.append(tmqi_n_score)
-                    patches.append(fake[i:i+1,0:1,j*ps:(j+1)*ps,k*ps:(k+1)*ps])
-        tmqi_n_scores_sorted = sorted(tmqi_n_scores)
-        best_score = tmqi_n_scores_sorted[-1]
-        pseudo_label = patches[tmqi_n_scores.index(best_score)]
+        # split x split patches of every image, in (image, row, col) order
+        patches = fake[:, 0:1, :split*ps, :split*ps].reshape(fake.shape[0], 1, split, ps, split, ps)
+        patches = patches.permute(0, 2, 4, 1, 3, 5).reshape(-1, 1, ps, ps)
+        # the patches are ranked by TMQI naturalness, which only depends on the ldr side
+        with self.profiler.phase("tmqi"):
+            tmqi_n_scores = self.tmqi.naturalness(patches.detach() * 255)
+        pseudo_label = patches.index_select(0, torch.argmax(tmqi_n_scores).view(1))
         loss = 0
         l1_loss = nn.L1Loss()
-        pseudo_label = pseudo_label.repeat(len(patches),1,1,1)
-        patches = torch.cat(patches, 0)
+        pseudo_label = pseudo_label.repeat(patches.shape[0],1,1,1)
         loss += l1_loss(patches.mean(dim=[-1, -2]), pseudo_label.mean(dim=[-1, -2]))
-        contrast_extracter = ContrastExtracter()
-        patches_contrast = contrast_extracter(patches)
-        pseudo_label_contrast = contrast_extracter(pseudo_label)
+        patches_contrast = self.contrast_extracter(patches)
+        pseudo_label_contrast = self.contrast_extracter(pseudo_label)
         loss += l1_loss(patches_contrast.mean(dim=[-1, -2]), pseudo_label_contrast.mean(dim=[-1, -2]))
         return loss
 
@@ -386,21 +606,14 @@ class GanTrainer:
 
         infoNCE_loss = 0
 
-        fake_imgs = fake.permute(0,2,3,1).detach().cpu().numpy()
-        hdr_inputs = hdr_input.permute(0,2,3,1).detach().cpu().numpy()
-        
-        tmqi = TMQI()
-        tmqi_n_scores = []
-        for i in range(fake.shape[0]):
-            tmqi_score, tmqi_s_score, tmqi_n_score, _, _ = tmqi(hdr_inputs[i,:,:,0], fake_imgs[i,:,:,0]*255)
-            tmqi_n_scores.append(tmqi_n_score)
-        tmqi_n_scores_sorted = sorted(tmqi_n_scores)
-        
+        with self.profiler.phase("tmqi"):
+            tmqi_n_scores = self.tmqi.naturalness(fake[:, 0].detach() * 255)
+
         fea_anchor2 = fea_fake
         feas_positive2 = []
         feas_negative2 = []
-        fea_positive = fea_fake[tmqi_n_scores.index(tmqi_n_scores_sorted[-1]),:,:,:].unsqueeze(0).repeat(fea_fake.shape[0],1,1,1)
-        fea_negative = fea_fake[tmqi_n_scores.index(tmqi_n_scores_sorted[0]),:,:,:].unsqueeze(0).repeat(fea_fake.shape[0],1,1,1)
+        fea_positive = fea_fake.index_select(0, torch.argmax(tmqi_n_scores).view(1)).repeat(fea_fake.shape[0],1,1,1)
+        fea_negative = fea_fake.index_select(0, torch.argmin(tmqi_n_scores).view(1)).repeat(fea_fake.shape[0],1,1,1)
         feas_positive2.append(fea_positive)
         feas_negative2.append(fea_negative)
         nce_loss2 = self.nce(fea_anchor2, feas_positive2, feas_negative2, cl_loss_type, k, constant)
@@ -412,6 +625,10 @@ class GanTrainer:
 
         loss = 0
         b, c, h, w = fea_anchor.shape
+        # 1 / (c + k * |a - b|) is sensitive to rounding, always computed in fp32
+        fea_anchor = fea_anchor.float()
+        feas_positive = [f.float() for f in feas_positive]
+        feas_negative = [f.float() for f in feas_negative]
 
         neg_logits = []
 
@@ -456,10 +673,10 @@ class GanTrainer:
             #print(fake.shape)
             #print(hdr_input_original_gray_norm.shape)
             #print(hdr_input.shape)
-            self.errG_struct = self.struct_loss_factor * self.struct_loss(fake, hdr_input_original_gray_norm,
-                                                                          hdr_input, self.pyramid_weight_list)
-            self.errG_struct.backward()
-            self.G_loss_struct.append(self.errG_struct.item())
+            with self.profiler.phase("struct_loss"):
+                self.errG_struct = self.struct_loss_factor * self.struct_loss(fake, hdr_input_original_gray_norm,
+                                                                              hdr_input, self.pyramid_weight_list)
+            self.metrics.update("errG_struct", self.errG_struct)
 
     def verify_checkpoint(self):
         if self.isCheckpoint:
@@ -478,24 +695,41 @@ class GanTrainer:
                                         acc_file_name,
                                         self.epoch, acc_path)
         if not self.pre_train_mode:
-            plot_util.plot_general_losses(self.G_loss_d, self.G_loss_struct, self.G_loss_intensity, self.D_loss_fake,
-                                          self.D_loss_real, "summary epoch_=_" + str(epoch), self.num_iter, loss_path,
-                                          (self.loss_g_d_factor != 0), (self.struct_loss_factor != 0))
+            self.metrics.flush()
+            plot_util.plot_losses_series(self.get_loss_series_path(), "summary epoch_=_" + str(epoch), loss_path,
+                                         (self.loss_g_d_factor != 0), (self.struct_loss_factor != 0))
+
+    def get_loss_series_path(self, pretrain=False):
+        """
+        :return: file of the MetricBuffer loss series, None on the distributed ranks other than 0
+        """
+        if not self.is_main_process:
+            return None
+        return os.path.join(self.output_dir, "loss_plot", "loss_series_pretrain.csv" if pretrain else "loss_series.csv")
 
     def load_model(self):
         if self.isCheckpoint:
-            self.checkpoint = torch.load(params.models_save_path)
+            path = checkpoint_util.find_latest_checkpoint(
+                self.resume_path or os.path.join(self.output_dir, params.models_save_path))
+            print("loading checkpoint %s" % path)
+            self.checkpoint = torch.load(path, map_location=self.device)
             self.epoch = self.checkpoint['epoch']
             self.netD.load_state_dict(self.checkpoint['modelD_state_dict'])
             self.netG.load_state_dict(self.checkpoint['modelG_state_dict'])
             self.optimizerD.load_state_dict(self.checkpoint['optimizerD_state_dict'])
             self.optimizerG.load_state_dict(self.checkpoint['optimizerG_state_dict'])
+            # checkpoints without train_state restart their epoch
+            if 'train_state' in self.checkpoint:
+                self.load_train_state(self.checkpoint['train_state'])
+            self.resumed = True
+            if self.checkpoint_writer is not None:
+                self.checkpoint_writer.restore()
             self.netD.train()
             self.netG.train()
 
     def update_accuracy(self):
-        len_hdr_train_dset = len(self.train_data_loader_npy.dataset)
-        len_ldr_train_dset = len(self.train_data_loader_ldr.dataset)
+        len_hdr_train_dset = len(self.train_data_loader.dataset.hdr_dataset)
+        len_ldr_train_dset = len(self.train_data_loader.dataset.ldr_pos_dataset)
         self.accG = self.accG_counter / len_hdr_train_dset
         self.accDreal = self.accDreal_counter / len_ldr_train_dset
         self.accDfake = self.accDfake_counter / len_ldr_train_dset
@@ -518,6 +752,8 @@ class GanTrainer:
         self.D_accuracy_fake.append(self.accDfake)
 
     def print_epoch_summary(self, epoch, epoch_iter):
+        if not self.is_main_process:
+            return
         #print("Single [[epoch]] iteration took [%.4f] seconds\n" % (time.time() - start))
         if self.train_with_D:
             printer.print_epoch_losses_summary(epoch, self.num_epochs, self.errD.item(), 0,
@@ -530,19 +766,77 @@ class GanTrainer:
                                                self.errG_mu)
         #printer.print_epoch_acc_summary(epoch, self.num_epochs, self.accDfake, self.accDreal, self.accG)
         #if epoch % self.epoch_to_save == 0:
-        self.tester.save_test_images(epoch, epoch_iter, self.output_dir, self.input_images_mean, self.netD, self.netG,
-                                     0, self.struct_loss, self.num_epochs, self.to_crop)
-        #self.save_loss_plot(epoch, self.output_dir)
-        #print('process hdr images')
-        self.tester.save_images_for_model(self.netG, self.output_dir, epoch, epoch_iter)
+        with self.profiler.phase("eval"):
+            if self.eval_worker is not None:
+                # evaluated in the background, the checkpoint gets its metric when the result comes back
+                self.eval_worker.submit(epoch, epoch_iter, self.netG, self.netD)
+                self.report_eval_results()
+                tmqi = None
+            else:
+                # the tester runs the nets outside of their DataParallel wrappers (not distributed, see config)
+                self.tester.save_test_images(epoch, epoch_iter, self.output_dir, self.input_images_mean,
+                                             dist_util.unwrap(self.netD), dist_util.unwrap(self.netG),
+                                             0, self.struct_loss, self.num_epochs, self.to_crop)
+                #self.save_loss_plot(epoch, self.output_dir)
+                #print('process hdr images')
+                tmqi = self.tester.save_images_for_model(dist_util.unwrap(self.netG), self.output_dir, epoch, epoch_iter)
         #print('process hdr images done')
-        model_save_util.save_model(params.models_save_path, epoch, epoch_iter, self.output_dir, self.netG, self.optimizerG,
-                                    self.netD, self.optimizerD)
+        self.save_checkpoint(epoch, epoch_iter, metric=tmqi)
         # if epoch == self.final_epoch:
         #     model_save_util.save_model(params.models_save_path, epoch, self.output_dir, self.netG, self.optimizerG,
         #                                self.netD, self.optimizerD)
         #     self.save_data_for_assessment()
 
+    def save_checkpoint(self, epoch, epoch_iter, metric=None):
+        """
+        resumable checkpoint of the state after step epoch_iter of epoch, written by the background writer
+        """
+        if self.last_checkpoint_iter == self.num_iter:
+            return
+        self.last_checkpoint_iter = self.num_iter
+        with self.profiler.phase("checkpoint"):
+            self.checkpoint_writer.save(model_save_util.get_checkpoint_state(epoch, self.netG, self.optimizerG,
+                                                                             self.netD, self.optimizerD,
+                                                                             self.get_train_state(epoch_iter)),
+                                        model_save_util.get_checkpoint_name(epoch, epoch_iter), metric=metric)
+
+    def get_train_state(self, epoch_iter):
+        """
+        the trainer state besides the weights and the optimizers, so a resumed run continues with the next batch
+        """
+        self.metrics.flush()
+        return {"epoch_iter": epoch_iter,
+                "num_iter": self.num_iter,
+                "lr_scheduler_G": self.lr_scheduler_G.state_dict(),
+                "lr_scheduler_D": self.lr_scheduler_D.state_dict(),
+                "scaler": self.scaler.state_dict(),
+                "rng": checkpoint_util.get_rng_state(self.device),
+                "sampler_seed": self.train_data_loader.sampler.seed,
+                "accuracy": {"G": self.G_accuracy, "D_real": self.D_accuracy_real, "D_fake": self.D_accuracy_fake}}
+
+    def load_train_state(self, state):
+        self.resume_epoch_iter = state["epoch_iter"]
+        self.num_iter = state["num_iter"]
+        self.lr_scheduler_G.load_state_dict(state["lr_scheduler_G"])
+        self.lr_scheduler_D.load_state_dict(state["lr_scheduler_D"])
+        # empty when saved without fp16 loss scaling
+        if state["scaler"]:
+            self.scaler.load_state_dict(state["scaler"])
+        self.resume_rng_state = state["rng"]
+        self.train_data_loader.sampler.seed = state["sampler_seed"]
+        self.G_accuracy = state["accuracy"]["G"]
+        self.D_accuracy_real = state["accuracy"]["D_real"]
+        self.D_accuracy_fake = state["accuracy"]["D_fake"]
+        print("resuming epoch %d at iteration %d (step %d)" % (self.epoch, self.resume_epoch_iter, self.num_iter))
+
+    def report_eval_results(self, results=None):
+        if results is None:
+            results = self.eval_worker.poll()
+        for result in results:
+            print("[eval] epoch %d iter %d: TMQI %.6f" % (result["epoch"], result["epoch_iter"], result["tmqi"]))
+            self.checkpoint_writer.set_metric(model_save_util.get_checkpoint_name(result["epoch"], result["epoch_iter"]),
+                                              result["tmqi"])
+
     def save_data_for_assessment(self):
         model_params = model_save_util.get_model_params(self.output_dir,
                                                         train_settings_path=os.path.join(self.output_dir,
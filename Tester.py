@@ -9,7 +9,7 @@ import tranforms
 import utils.data_loader_util as data_loader_util
 import utils.hdr_image_util as hdr_image_util
 import utils.plot_util as plot_util
-from utils import printer, adaptive_lambda
+from utils import printer, adaptive_lambda, lambda_index
 #import time
 from TMQI import TMQI, TMQIr
 import imageio
@@ -230,9 +230,8 @@ class Tester:
         #print(f_factor_path)
         #f_factor_path = "lambda_data/input_images_lambdas_HDRSdataset.npy"
         #f_factor_path = "lambda_data/input_images_lambdas_Kalantari13_1.npy"
-        data = np.load(f_factor_path, allow_pickle=True)[()]
         #f_factor = data[os.path.splitext(os.path.basename(im_path))[0]] * 255 * factor_coeff
-        f_factor = data[im_path.split('/')[-2]] * 255 * factor_coeff
+        f_factor = lambda_index.get_lambda(f_factor_path, im_path.split('/')[-2]) * 255 * factor_coeff
         rgb_img = hdr_image_util.read_hdr_image(im_path)
         rgb_original = rgb_img.copy()
         #print('-------------------')
@@ -310,6 +309,7 @@ class Tester:
                                                align_corners=False).squeeze(dim=0).clamp(min=0, max=im_max)
                 hdr_image_util.save_gray_tensor_as_numpy_stretch(fake_im_color2, out_dir + "/color_stretch",
                                                                  im_and_q["im_name"] + "_color_stretch")
+        return tmqi_final
 
     def eval_on_video(self, G_net, im_paths, device, im_names, f_factor_path, final_shape_addition, epoch, epoch_iter):
         gray_im_logs = []
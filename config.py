@@ -5,23 +5,47 @@ import random
 import numpy as np
 import torch
 
-from utils import params
+from utils import params, loss_schedule, dist_util
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Parser for gan network")
     # ====== GENERAL SETTINGS ======
-    parser.add_argument("--checkpoint", type=int, default=0)
+    parser.add_argument("--checkpoint", type=int, default=0, help="resume the run from a checkpoint")
+    parser.add_argument("--resume_path", type=str, default="",
+                        help="checkpoint file, or folder whose latest checkpoint is resumed, default <output_dir>/models")
     parser.add_argument("--change_random_seed", type=int, default=10)
+    parser.add_argument("--train_profile", type=str, default="production",
+                        help="production/debug, debug runs autograd anomaly detection and per-step prints")
+    parser.add_argument("--nan_check_every", type=int, default=0,
+                        help="check the step losses for nan/inf every N iterations, 0 to disable")
+    parser.add_argument("--profile_every", type=int, default=0,
+                        help="write the train step phase timings to <output_dir>/profile every N steps, 0 to disable")
+    parser.add_argument("--profile_window", type=int, default=100, help="steps of the rolling timing statistics")
+    parser.add_argument("--profile_sync", type=int, default=1,
+                        help="synchronize cuda around the profiled phases, so the kernels are timed in their phase")
+    parser.add_argument("--profile_trace_start", type=int, default=10, help="first step of the torch.profiler trace, from 1 (steps count from 0)")
+    parser.add_argument("--profile_trace_steps", type=int, default=0,
+                        help="steps recorded by torch.profiler to <output_dir>/profile/trace, 0 to disable")
+    parser.add_argument("--distributed", type=int, default=0,
+                        help="DistributedDataParallel training, one process per device started with torchrun")
+    parser.add_argument("--dist_backend", type=str, default="",
+                        help="nccl/gloo, empty picks nccl on gpus and gloo on cpu")
 
     # ====== TRAINING ======
-    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--batch_size", type=int, default=2, help="per process when distributed")
     parser.add_argument("--num_epochs", type=int, default=1)
     parser.add_argument("--G_lr", type=float, default=params.lr)
     parser.add_argument("--D_lr", type=float, default=params.lr)
     parser.add_argument("--lr_decay_step", type=float, default=1)
     parser.add_argument("--d_pretrain_epochs", type=int, default=5)
     parser.add_argument('--use_xaviar', type=int, default=1)
+    parser.add_argument("--micro_batches", type=int, default=1,
+                        help="split every batch into N micro batches with accumulated gradients, "
+                             "the contrastive losses still compare the whole batch "
+                             "(the G gradients are approximate, see GanTrainer.G_pass), needs --unet_norm none")
+    parser.add_argument("--amp", type=str, default="none",
+                        help="none/bf16/fp16, autocast of the G and D forward passes (bf16 also on cpu)")
 
     # ====== SLIDER_MODE ======
     parser.add_argument("--manual_d_training", type=int, default=0)
@@ -56,6 +80,9 @@ def parse_arguments():
     parser.add_argument('--convtranspose_kernel', type=int, default=2)
     parser.add_argument('--final_shape_addition', type=int, default=0)
     parser.add_argument('--up_mode', type=int, default=0)
+    parser.add_argument("--g_checkpoint", type=str, default="none",
+                        help="none/block/frame, activation checkpointing of the video G: every down/gcn/up block "
+                             "or every whole frame step is recomputed in the backward instead of stored")
     parser.add_argument("--input_dim", type=int, default=1)
     parser.add_argument("--output_dim", type=int, default=1)
 
@@ -67,6 +94,12 @@ def parse_arguments():
     parser.add_argument("--ssim_loss_factor", type=float, default=1)
     parser.add_argument("--ssim_window_size", type=int, default=5)
     parser.add_argument('--pyramid_weight_list', help='delimited list input', type=str, default="1,1,1")
+    parser.add_argument("--loss_schedule", type=str, default=loss_schedule.DEFAULT_LOSS_SCHEDULE,
+                        help="per-phase weights of the G adversarial terms, 'term:w1,w2,w3;...' or a json file")
+    parser.add_argument("--loss_schedule_epochs", type=str, default=loss_schedule.DEFAULT_PHASE_EPOCHS,
+                        help="last epoch of every loss phase but the final one")
+    parser.add_argument("--loss_skip_threshold", type=float, default=1e-5,
+                        help="G adversarial terms weighted below this are not computed")
 
     # ====== DATASET ======
     parser.add_argument("--data_root_npy", type=str, default=params.train_dataroot_hdr)
@@ -91,11 +124,45 @@ def parse_arguments():
     parser.add_argument('--min_stretch', type=float, default=0)
     parser.add_argument("--add_frame", type=int, default=0)
     parser.add_argument("--normalization", type=str, default='bugy_max_normalization', help='max/min_max')
+    parser.add_argument("--npy_mmap", type=int, default=0, help="memory map the patch files and copy only the crop windows out of them")
+    parser.add_argument("--log_luma_cache", type=int, default=0,
+                        help="cut hdr crops out of gray / log10 maps cached next to the npy patches")
+    parser.add_argument("--num_workers", type=int, default=params.workers, help="DataLoader worker processes per train loader")
+    parser.add_argument("--pin_memory", type=int, default=1)
+    parser.add_argument("--prefetch_factor", type=int, default=2, help="batches loaded in advance by each worker")
+    parser.add_argument("--train_shards_dir", type=str, default="",
+                        help="read the train data from the shards packed by utils/shard_util.py")
+    parser.add_argument("--batch_augment", type=int, default=0,
+                        help="scale, crop and normalise the train batches on the device (utils/batch_augment.py)")
+    parser.add_argument("--augment_raw_size", type=int, default=512, help="size of the raw frames for batch_augment")
+    parser.add_argument("--clip_length", type=int, default=2, help="frames per video train sample")
+    parser.add_argument("--train_stream", type=int, default=0,
+                        help="read the train hdr/ldr images from their .exr/.hdr/.dng/.png files instead of npy")
+    parser.add_argument("--stream_image_size", type=int, default=1024, help="short side of the cached streamed images")
+    parser.add_argument("--stream_cache_mb", type=int, default=4096, help="decoded images cache size, per worker")
+    parser.add_argument("--stream_threads", type=int, default=4, help="decoding threads, per worker")
+    parser.add_argument("--stream_lambda_path", type=str, default="",
+                        help="lambda table of the streamed hdr images, keyed by their original file names, "
+                             "default f_train_dict_path")
+    parser.add_argument("--sampling_ratios", type=str, default="1,0,0",
+                        help="part of the hdr, ldr_pos and ldr_neg train sets seen per epoch, "
+                             "the longest one sets the epoch length and shorter sets are cycled")
 
     # ====== SAVE RESULTS ======
     parser.add_argument("--epoch_to_save", type=int, default=2)
     parser.add_argument("--result_dir_prefix", type=str, default="")
     parser.add_argument("--final_epoch", type=int, default=1)
+    parser.add_argument("--metrics_buffer_size", type=int, default=500,
+                        help="train steps of losses kept on the device before they are written to loss_plot/loss_series.csv")
+    parser.add_argument("--snapshot_every", type=int, default=0,
+                        help="also write a resumable checkpoint every N train steps, 0 only at the evaluations")
+    parser.add_argument("--keep_checkpoints", type=int, default=5,
+                        help="number of recent checkpoints kept on disk (plus the best one), 0 keeps all")
+    parser.add_argument("--async_checkpoint", type=int, default=1, help="write the checkpoints from a background thread")
+    parser.add_argument("--eval_worker", type=int, default=0,
+                        help="run the periodic test evaluation in a separate process instead of pausing training")
+    parser.add_argument("--eval_max_pending", type=int, default=1,
+                        help="evaluations queued or running at once, later snapshots are skipped")
     parser.add_argument("--fid_real_path", type=str,
                         default="/cs/snapless/raananf/yael_vinker/data/div2k_large/test_half2")  # default="/Users/yaelvinker/PycharmProjects/lab/fid/fake_jpg")#
     parser.add_argument("--fid_res_path", type=str,
@@ -107,21 +174,32 @@ def parse_arguments():
 
 def get_opt():
     opt = parse_arguments()
+    if opt.distributed:
+        # an inline evaluation on rank 0 leaves the other ranks waiting in the next all-reduce,
+        # a long one runs into the process group timeout
+        if not opt.eval_worker:
+            raise Exception("distributed training needs --eval_worker 1")
+        device = dist_util.init_distributed(opt.dist_backend)
+    else:
+        device = torch.device("cuda" if (torch.cuda.is_available() and torch.cuda.device_count() > 0) else "cpu")
     if opt.change_random_seed > 1:
         manualSeed = opt.change_random_seed
     elif opt.change_random_seed == 1:
         manualSeed = random.randint(1, 10000)
     else:
         manualSeed = params.manualSeed
+    # every rank uses the seed of rank 0: it seeds the shared sampler shuffle and names the run folder
+    manualSeed = dist_util.broadcast_object(manualSeed)
     opt.manual_seed = manualSeed
     torch.manual_seed(manualSeed)
-    opt = define_dirs(opt)
+    with dist_util.main_process_first():
+        opt = define_dirs(opt)
     if opt.manual_d_training:
         opt.input_dim = 2
     opt.dataset_properties = get_dataset_properties(opt)
-    np.save(os.path.join(opt.output_dir, "run_settings.npy"), vars(opt))
+    if dist_util.is_main_process():
+        np.save(os.path.join(opt.output_dir, "run_settings.npy"), vars(opt))
 
-    device = torch.device("cuda" if (torch.cuda.is_available() and torch.cuda.device_count() > 0) else "cpu")
     opt.device = device
     opt.pyramid_weight_list = torch.FloatTensor([float(item) for item in opt.pyramid_weight_list.split(',')]).to(device)
     opt.adv_weight_list = torch.FloatTensor([float(item) for item in opt.adv_weight_list.split(',')]).to(
@@ -164,7 +242,24 @@ def get_dataset_properties(opt):
                           "use_contrast_ratio_f": opt.use_contrast_ratio_f,
                           "use_hist_fit": opt.use_hist_fit,
                           "f_train_dict_path": opt.f_train_dict_path,
-                          "final_shape_addition": opt.final_shape_addition}
+                          "final_shape_addition": opt.final_shape_addition,
+                          "npy_mmap": opt.npy_mmap,
+                          "log_luma_cache": opt.log_luma_cache,
+                          "num_workers": opt.num_workers,
+                          "pin_memory": opt.pin_memory,
+                          "prefetch_factor": opt.prefetch_factor,
+                          "train_shards_dir": opt.train_shards_dir,
+                          "batch_augment": opt.batch_augment,
+                          "augment_raw_size": opt.augment_raw_size,
+                          "clip_length": opt.clip_length,
+                          "sampling_ratios": [float(item) for item in opt.sampling_ratios.split(',')],
+                          "distributed": opt.distributed,
+                          "seed": opt.manual_seed,
+                          "train_stream": opt.train_stream,
+                          "stream_image_size": opt.stream_image_size,
+                          "stream_cache_mb": opt.stream_cache_mb,
+                          "stream_threads": opt.stream_threads,
+                          "stream_lambda_path": opt.stream_lambda_path}
     return dataset_properties
 
 
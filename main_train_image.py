@@ -4,20 +4,13 @@ import torch.optim as optim
 import GanTrainerImg
 import config
 import utils.model_save_util as model_save_util
-from utils import printer, params
+from utils import dist_util, printer, params
 
 if __name__ == '__main__':
     opt = config.get_opt()
     printer.print_opt(opt)
 
-    net_G = model_save_util.create_G_net2(opt.model, opt.device, opt.checkpoint, opt.input_dim, opt.last_layer,
-                                         opt.filters, opt.con_operator, opt.unet_depth, opt.add_frame,
-                                         opt.unet_norm, opt.stretch_g, opt.g_activation, opt.use_xaviar,
-                                         opt.output_dim, opt.g_doubleConvTranspose, opt.bilinear,
-                                         opt.padding, opt.convtranspose_kernel, opt.up_mode)
-    net_D = model_save_util.create_D_net(opt.output_dim, opt.d_down_dim, opt.device, opt.checkpoint, opt.d_norm,
-                                         opt.use_xaviar, opt.d_model, opt.d_nlayers, opt.d_last_activation,
-                                         opt.num_D, opt.d_fully_connected, opt.simpleD_maxpool, opt.d_padding)
+    net_G, net_D = model_save_util.create_train_nets(opt, image_mode=True)
 
     input_size = params.input_size
     printer.print_net("D", net_D, opt, input_size=input_size)
@@ -35,3 +28,4 @@ if __name__ == '__main__':
 
     gan_trainer = GanTrainerImg.GanTrainer(opt, net_G, net_D, optimizer_G, optimizer_D, lr_scheduler_G, lr_scheduler_D)
     gan_trainer.train()
+    dist_util.cleanup()
@@ -1,8 +1,7 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
-from models import Blocks
-import numpy as np
+from models import Blocks, gaussian_contrast
 
 
 class Discriminator(nn.Module):
@@ -47,43 +46,6 @@ class Flatten(nn.Module):
         x = x.view(x.size()[0], -1)
         return x
 
-def fspecial_gauss(size, sigma, channels):
-    # Function to mimic the 'fspecial' gaussian MATLAB function
-    x, y = np.mgrid[-size//2 + 1:size//2 + 1, -size//2 + 1:size//2 + 1]
-    g = np.exp(-((x**2 + y**2)/(2.0*sigma**2)))
-    g = torch.from_numpy(g/g.sum()).float().unsqueeze(0).unsqueeze(0)
-    return g.repeat(channels,1,1,1)
-
-def gaussian_filter(input, win):
-    out = F.conv2d(input, win, stride=1, padding=0, groups=input.shape[1])
-    return out
-
-def compute_contrast(X, win):
-    b, c, h, w = X.shape
-    X_reshape = X.reshape(b*c, 1, h, w)
-    win = win.to(X.device)
-
-    mu1 = gaussian_filter(X_reshape, win)
-    mu1_sq = mu1.pow(2)
-    #sigma1_sq = gaussian_filter(X * X, win) - mu1_sq
-    sigma1_sq = gaussian_filter(X_reshape * X_reshape, win) - mu1_sq
-    sigma1_sq = sigma1_sq.reshape(b, c, sigma1_sq.shape[2], sigma1_sq.shape[3])
-        
-    return sigma1_sq
-
-
-class ContrastExtracter(torch.nn.Module):
-    def __init__(self, channels=1):
-
-        super(ContrastExtracter, self).__init__()
-        self.win = fspecial_gauss(11, 1.5, 1)
-
-    def forward(self, X):
-        contrast_map = compute_contrast(X, win=self.win)
-        return contrast_map
-
-
-
 class SimpleDiscriminator(nn.Module):
     def __init__(self, input_size, input_dim, dim, norm, last_activation, simpleD_maxpool, padding):
         super(SimpleDiscriminator, self).__init__()
@@ -91,7 +53,7 @@ class SimpleDiscriminator(nn.Module):
             sub = 0
         else:
             sub = 2
-        self.contrast_extracter = ContrastExtracter()
+        self.contrast_extracter = gaussian_contrast.ContrastExtracter()
         self.model = []
         self.tail = []
         self.model += [nn.Conv2d(input_dim, dim, 4, 2, padding=padding, bias=True),
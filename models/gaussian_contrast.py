@@ -0,0 +1,61 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+# (size, sigma, device, dtype) -> 1d kernel, built once per device
+_kernels = {}
+
+
+def gaussian_kernel_1d(size=11, sigma=1.5, device=None, dtype=torch.float32):
+    """
+    normalised 1d gaussian, its outer product with itself is the 'fspecial' gaussian of MATLAB.
+    kernels are cached on their device, so the training step does not build / copy them again.
+    """
+    key = (size, sigma, str(device), dtype)
+    if key not in _kernels:
+        x = [i - (size - 1) / 2. for i in range(size)]
+        g = torch.tensor([math.exp(-(v ** 2) / (2.0 * sigma ** 2)) for v in x], dtype=torch.float64)
+        _kernels[key] = (g / g.sum()).to(device=device, dtype=dtype)
+    return _kernels[key]
+
+
+def fspecial_gauss(size, sigma, channels, device=None):
+    # Function to mimic the 'fspecial' gaussian MATLAB function
+    g = gaussian_kernel_1d(size, sigma, device)
+    return torch.outer(g, g).view(1, 1, size, size).repeat(channels, 1, 1, 1)
+
+
+def gaussian_filter(X, size=11, sigma=1.5):
+    """
+    "valid" gaussian filtering of (n, 1, h, w) maps, as two 1d convolutions (2 * size taps instead of size^2).
+    """
+    g = gaussian_kernel_1d(size, sigma, X.device, X.dtype)
+    out = F.conv2d(X, g.view(1, 1, size, 1))
+    return F.conv2d(out, g.view(1, 1, 1, size))
+
+
+def compute_contrast(X, size=11, sigma=1.5):
+    """
+    local variance of every channel of X (b, c, h, w) under a gaussian window.
+    E[x^2] - E[x]^2 cancels badly in half precision, it is computed in fp32 also under autocast.
+    :return: (b, c, h - size + 1, w - size + 1), in the dtype of X
+    """
+    b, c, h, w = X.shape
+    with torch.autocast(device_type=X.device.type, enabled=False):
+        X_reshape = X.reshape(b * c, 1, h, w).float()
+        mu1 = gaussian_filter(X_reshape, size, sigma)
+        mu1_sq = mu1.pow(2)
+        sigma1_sq = gaussian_filter(X_reshape * X_reshape, size, sigma) - mu1_sq
+    return sigma1_sq.reshape(b, c, sigma1_sq.shape[2], sigma1_sq.shape[3]).to(X.dtype)
+
+
+class ContrastExtracter(torch.nn.Module):
+    def __init__(self, channels=1, size=11, sigma=1.5):
+        # every channel is filtered separately, "channels" is kept for the callers
+        super(ContrastExtracter, self).__init__()
+        self.size = size
+        self.sigma = sigma
+
+    def forward(self, X):
+        return compute_contrast(X, self.size, self.sigma)
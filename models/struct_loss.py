@@ -21,6 +21,11 @@ class StructLoss(torch.nn.Module):
         self.struct_method = struct_method
 
     def forward(self, fake, hdr_input_original_gray_norm, hdr_input, pyramid_weight_list):
+        # the window moments and the division by the local std are computed in fp32, also under autocast
+        with torch.autocast(device_type=fake.device.type, enabled=False):
+            return self.pyramid_loss(fake.float(), hdr_input.float(), pyramid_weight_list)
+
+    def pyramid_loss(self, fake, hdr_input, pyramid_weight_list):
         (_, channel, _, _) = fake.size()
         if channel == self.channel and self.window.data.type() == fake.data.type():
             window = self.window
@@ -57,9 +62,37 @@ def struct_loss_pyramid(img1, img2, window, window_size, channel, pyramid_weight
 def struct_loss(img1, img2, window, window_size, channel, mse_loss):
     """
     compute the structural loss between two images.
+    it is the mse between the windows of img1 and img2, each normalised by its local mean and std
+    (see struct_loss_windows), written in closed form with the local moments so the
+    window_size^2 copies of the images are never built:
+    mean_window((a - b)^2) = var1 / s1^2 + var2 / s2^2 - 2 * cov12 / (s1 * s2), s = std + epsilon.
+    the moments are computed on the images minus their mean (see center_images).
     :param img1: fake image
     :param img2: input image (after log)
     """
+    img1, img2 = center_images(img1), center_images(img2)
+    window = window / window.sum()
+    mu1 = F.conv2d(img1, window, groups=channel)
+    mu2 = F.conv2d(img2, window, groups=channel)
+
+    var1 = F.conv2d(img1 * img1, window, groups=1) - mu1.pow(2)
+    var2 = F.conv2d(img2 * img2, window, groups=1) - mu2.pow(2)
+    cov12 = F.conv2d(img1 * img2, window, groups=1) - mu1 * mu2
+    var1 = torch.max(var1, torch.zeros_like(var1))
+    var2 = torch.max(var2, torch.zeros_like(var2))
+
+    s1 = torch.pow(var1 + params.epsilon2, 0.5) + params.epsilon2
+    s2 = torch.pow(var2 + params.epsilon2, 0.5) + params.epsilon2
+    window_mse = var1 / s1.pow(2) + var2 / s2.pow(2) - 2 * cov12 / (s1 * s2)
+    return window_mse.mean()
+
+
+def struct_loss_windows(img1, img2, window, window_size, channel, mse_loss):
+    """
+    reference version of struct_loss that unfolds the images into their windows,
+    it needs window_size^2 times the memory of the images.
+    """
+    img1, img2 = center_images(img1), center_images(img2)
     window = window / window.sum()
     mu1 = F.conv2d(img1, window, groups=channel)
     mu2 = F.conv2d(img2, window, groups=channel)
@@ -90,6 +123,16 @@ def struct_loss(img1, img2, window, window_size, channel, mse_loss):
 # =======================================
 # ========= Helper Functions ============
 # =======================================
+def center_images(img):
+    """
+    subtract the mean of every image, which leaves the local variances and covariances unchanged.
+    E[x^2] - E[x]^2 in fp32 has an error ~1e-7 * E[x]^2, a large part of the ~1e-6 variance of near flat
+    windows (then divided by s^2 ~ 1e-5): on centered images it is ~1e-7 * (local mean - image mean)^2.
+    the mean is a constant shift, it gets no gradient.
+    """
+    return img - img.mean(dim=(2, 3), keepdim=True).detach()
+
+
 def create_window(window_size, channel):
     window = torch.ones((1, channel, window_size, window_size))
     return window / window.sum()
@@ -102,3 +145,4 @@ def get_im_as_windows(a, wind_size):
                               windows.shape[2], windows.shape[3],
                               wind_size * wind_size)
     return windows
+
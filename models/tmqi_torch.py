@@ -0,0 +1,160 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+# constants of TMQI.TMQI (original mode)
+TMQI_A = 0.8012
+TMQI_ALPHA = 0.3046
+TMQI_BETA = 0.7088
+S_LEVELS = 5
+S_WEIGHTS = [0.0448, 0.2856, 0.3001, 0.2363, 0.1333]
+N_PHAT1 = 4.4
+N_PHAT2 = 10.1
+N_MUHAT = 115.94
+N_SIGMAHAT = 27.99
+N_BLOCK = 11
+
+
+def gaussian_window(size=11, sigma=1.5, dtype=torch.float64, device=None):
+    # scipy.signal.gaussian(11, 1.5) outer product, normalised like TMQI._Slocal
+    n = torch.arange(size, dtype=dtype, device=device) - (size - 1) / 2.
+    gauss = torch.exp(-0.5 * (n / sigma) ** 2)
+    window = torch.outer(gauss, gauss)
+    return (window / window.sum()).view(1, 1, size, size)
+
+
+def to_batch(im):
+    """
+    (B, H, W) or (B, 1, H, W) -> (B, 1, H, W) float64
+    """
+    if im.dim() == 3:
+        im = im.unsqueeze(1)
+    return im.double()
+
+
+def beta_pdf_ratio(x, mode):
+    """
+    beta.pdf(x, phat1, phat2) / beta.pdf(mode, phat1, phat2), 0 outside (0, 1) as in scipy
+    """
+    inside = (x > 0) & (x < 1)
+    x = x.clamp(1e-12, 1 - 1e-12)
+    log_pdf = (N_PHAT1 - 1) * torch.log(x) + (N_PHAT2 - 1) * torch.log1p(-x)
+    log_mode = (N_PHAT1 - 1) * math.log(mode) + (N_PHAT2 - 1) * math.log1p(-mode)
+    return torch.where(inside, torch.exp(log_pdf - log_mode), torch.zeros_like(x))
+
+
+def statistical_naturalness(ldr):
+    """
+    batched TMQI._StatisticalNaturalness (original mode), ldr in [0, 255].
+    :param ldr: (B, H, W) or (B, 1, H, W)
+    :return: (B,) naturalness scores
+    """
+    ldr = to_batch(ldr)
+    b, _, h, w = ldr.shape
+    u = ldr.mean(dim=[1, 2, 3])
+    # TMQI always adds (11 - size % 11) zero rows / cols, a whole block when the size is a multiple of 11
+    blocks = F.pad(ldr, (0, N_BLOCK - w % N_BLOCK, 0, N_BLOCK - h % N_BLOCK))
+    bh, bw = blocks.shape[2] // N_BLOCK, blocks.shape[3] // N_BLOCK
+    blocks = blocks.view(b, bh, N_BLOCK, bw, N_BLOCK)
+    sig = blocks.std(dim=(2, 4), unbiased=False).mean(dim=[1, 2])
+    beta_mode = (N_PHAT1 - 1.) / (N_PHAT1 + N_PHAT2 - 2.)
+    pc = beta_pdf_ratio(sig / 64.29, beta_mode)
+    pb = torch.exp(-(u - N_MUHAT) ** 2 / (2 * N_SIGMAHAT ** 2))
+    return pb * pc
+
+
+def normal_cdf(x, loc, scale):
+    return 0.5 * (1 + torch.erf((x - loc) / (scale * math.sqrt(2))))
+
+
+def s_local(img1, img2, window, sf, C1=0.01, C2=10.):
+    """
+    batched TMQI._Slocal
+    :return: (B,) mean of the s map
+    """
+    mu1 = F.conv2d(img1, window)
+    mu2 = F.conv2d(img2, window)
+    mu1_sq = mu1 * mu1
+    mu2_sq = mu2 * mu2
+    mu1_mu2 = mu1 * mu2
+    sigma1_sq = F.conv2d(img1 * img1, window) - mu1_sq
+    sigma2_sq = F.conv2d(img2 * img2, window) - mu2_sq
+    sigma1 = torch.sqrt(sigma1_sq.clamp(min=0))
+    sigma2 = torch.sqrt(sigma2_sq.clamp(min=0))
+    sigma12 = F.conv2d(img1 * img2, window) - mu1_mu2
+
+    CSF = 100.0 * 2.6 * (0.0192 + 0.114 * sf) * math.exp(- (0.114 * sf) ** 1.1)
+    u_hdr = 128 / (1.4 * CSF)
+    sig_hdr = u_hdr / 3.
+    sigma1p = normal_cdf(sigma1, u_hdr, sig_hdr)
+    sigma2p = normal_cdf(sigma2, u_hdr, sig_hdr)
+
+    s_map = ((2 * sigma1p * sigma2p + C1) / (sigma1p ** 2 + sigma2p ** 2 + C1)
+             * ((sigma12 + C2) / (sigma1 * sigma2 + C2)))
+    return s_map.mean(dim=[1, 2, 3])
+
+
+def structural_fidelity(hdr, ldr, window=None):
+    """
+    batched TMQI._StructuralFidelity (original mode: hdr rescaled to [0, 2^32 - 1], ldr as is).
+    computed in float64, the rescaled hdr moments do not fit float32.
+    :return: (B,) structural fidelity scores
+    """
+    hdr, ldr = to_batch(hdr), to_batch(ldr)
+    if window is None:
+        window = gaussian_window(device=hdr.device)
+    factor = float(2 ** 32 - 1.)
+    hdr_min = hdr.amin(dim=[1, 2, 3], keepdim=True)
+    hdr_max = hdr.amax(dim=[1, 2, 3], keepdim=True)
+    L_hdr = factor * (hdr - hdr_min) / (hdr_max - hdr_min)
+    L_ldr = ldr
+    f = 32
+    S = torch.ones(hdr.shape[0], dtype=hdr.dtype, device=hdr.device)
+    for level in range(S_LEVELS):
+        f = f / 2
+        S = S * s_local(L_hdr, L_ldr, window, f) ** S_WEIGHTS[level]
+        # 2x2 averaging ("valid") + [::2, ::2] downsampling
+        L_hdr = F.avg_pool2d(L_hdr, 2)
+        L_ldr = F.avg_pool2d(L_ldr, 2)
+    return S
+
+
+class BatchTMQI(torch.nn.Module):
+    """
+    torch version of TMQI.TMQI (original mode) for gray images, scoring a whole batch on its device.
+    inputs are (B, H, W) or (B, 1, H, W): hdr luminance and ldr in [0, 255], like tmqi(hdr, ldr * 255).
+    scores are not differentiated, they are used to rank images.
+    run `python -m models.tmqi_torch` to compare it with TMQI.TMQI.
+    """
+
+    def __init__(self):
+        super(BatchTMQI, self).__init__()
+        self.register_buffer("window", gaussian_window(), persistent=False)
+
+    @torch.no_grad()
+    def naturalness(self, ldr):
+        return statistical_naturalness(ldr)
+
+    @torch.no_grad()
+    def forward(self, hdr, ldr):
+        """
+        :return: Q, S, N, each (B,)
+        """
+        N = statistical_naturalness(ldr)
+        S = structural_fidelity(hdr, ldr, self.window.to(hdr.device))
+        Q = TMQI_A * (S ** TMQI_ALPHA) + (1. - TMQI_A) * (N ** TMQI_BETA)
+        return Q, S, N
+
+
+if __name__ == '__main__':
+    import numpy as np
+    from TMQI import TMQI
+
+    rng = np.random.RandomState(0)
+    hdr = rng.rand(4, 128, 128) ** 4 * 1000
+    ldr = rng.rand(4, 128, 128) * 255
+    Q, S, N = BatchTMQI()(torch.from_numpy(hdr), torch.from_numpy(ldr))
+    for i in range(hdr.shape[0]):
+        q, s, n, _, _ = TMQI()(hdr[i], ldr[i])
+        print("[%d] Q %.6f / %.6f  S %.6f / %.6f  N %.6f / %.6f" % (i, q, Q[i], s, S[i], n, N[i]))
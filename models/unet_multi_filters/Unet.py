@@ -1,8 +1,8 @@
 # full assembly of the sub-parts to form the complete net
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint as checkpoint
 from torch.nn import Sequential as Seq
 
 from timm.data import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
@@ -13,7 +13,7 @@ from timm.models.registry import register_model
 from .gcn_lib import Grapher_noBN, act_layer
 
 from .unet_parts import *
-from models import Blocks
+from models import Blocks, gaussian_contrast
 import utils.printer
 from utils import data_loader_util
 
@@ -98,45 +98,15 @@ class GCNBlock(torch.nn.Module):
 
         return x
 
-def fspecial_gauss(size, sigma, channels):
-    # Function to mimic the 'fspecial' gaussian MATLAB function
-    x, y = np.mgrid[-size//2 + 1:size//2 + 1, -size//2 + 1:size//2 + 1]
-    g = np.exp(-((x**2 + y**2)/(2.0*sigma**2)))
-    g = torch.from_numpy(g/g.sum()).float().unsqueeze(0).unsqueeze(0)
-    return g.repeat(channels,1,1,1)
-
-def gaussian_filter(input, win):
-    out = F.conv2d(input, win, stride=1, padding=0, groups=1)
-    return out
-
-def compute_contrast(X, win):
-    b, c, h, w = X.shape
-    X_reshape = X.reshape(b*c, 1, h, w)
-    win = win.to(X.device)
-
-    mu1 = gaussian_filter(X_reshape, win)
-    mu1_sq = mu1.pow(2)
-    #sigma1_sq = gaussian_filter(X * X, win) - mu1_sq
-    sigma1_sq = gaussian_filter(X_reshape * X_reshape, win) - mu1_sq
-    sigma1_sq = sigma1_sq.reshape(b, c, sigma1_sq.shape[2], sigma1_sq.shape[3])
-        
-    return sigma1_sq
-
-class ContrastExtracter(torch.nn.Module):
-    def __init__(self, channels=1):
-
-        super(ContrastExtracter, self).__init__()
-        self.win = fspecial_gauss(11, 1.5, channels)
-
-    def forward(self, X):
-        contrast_map = compute_contrast(X, win=self.win)
-        return contrast_map
-
 class UNet(nn.Module):
     def __init__(self, n_channels, output_dim, last_layer, depth, layer_factor, con_operator, filters, bilinear,
                  network, dilation, to_crop, unet_norm, stretch_g, activation, doubleConvTranspose,
-                 padding_mode, convtranspose_kernel, up_mode=True, recurrent_ch_ratio=1/32):
+                 padding_mode, convtranspose_kernel, up_mode=True, recurrent_ch_ratio=1/32, checkpoint_mode="none"):
         super(UNet, self).__init__()
+        if checkpoint_mode not in ["none", "block", "frame"]:
+            raise Exception("unknown checkpoint_mode %s, use none/block/frame" % checkpoint_mode)
+        # activation checkpointing: "block" recomputes every down / gcn / up block, "frame" every whole frame step
+        self.checkpoint_mode = checkpoint_mode
         self.to_crop = to_crop
         self.con_operator = con_operator
         self.network = network
@@ -208,82 +178,107 @@ class UNet(nn.Module):
         else:
             self.stretch = None
 
-        self.contrast_extracter = ContrastExtracter()
+        self.contrast_extracter = gaussian_contrast.ContrastExtracter()
 
     def forward(self, x, apply_crop=True, diffY=0, diffX=0):
         #print(x.shape)
         output_results = []
         endecode_results_last = []
         features = []
+        checkpoint_frames = self.checkpoint_mode == "frame" and torch.is_grad_enabled()
         for k in range(x.shape[1]):
             x_frame = x[:,k,:,:,:]
-            endecode_results_curr = []
-                
-            d_weight_mul = 1.0
-            if self.con_operator == params.square_and_square_root_manual_d:
-                d_weight_mul = x_frame[0, 1, 0, 0]
-            # print("d_weight_mul", d_weight_mul)
-            next_x = self.inc(x_frame)
-            x_results = [next_x]
+            if checkpoint_frames:
+                # only the frame input, the recurrent carries and the outputs are kept, the step is recomputed
+                x_out, fea_final, endecode_results_curr = checkpoint.checkpoint(
+                    self.frame_step, x_frame, endecode_results_last, k, apply_crop, diffY, diffX, use_reentrant=False)
+            else:
+                x_out, fea_final, endecode_results_curr = self.frame_step(x_frame, endecode_results_last, k,
+                                                                          apply_crop, diffY, diffX)
+            features.append(fea_final.unsqueeze(1))
+            output_results.append(x_out.unsqueeze(1))
+            endecode_results_last = endecode_results_curr
+        output_results = torch.cat(output_results, 1)
+        features = torch.cat(features, 1)
+        return output_results, features
 
+    def run_block(self, block, *args):
+        """
+        block(*args), recomputed in the backward instead of keeping its activations in "block" checkpoint mode
+        """
+        if self.checkpoint_mode == "block" and torch.is_grad_enabled():
+            return checkpoint.checkpoint(block, *args, use_reentrant=False)
+        return block(*args)
+
+    def frame_step(self, x_frame, endecode_results_last, k, apply_crop, diffY, diffX):
+        """
+        encoder / gcn / decoder pass of frame k
+        :param endecode_results_last: recurrent carries of frame k - 1, the first recurrent_ch_ratio channels of
+                                      every block output
+        :return: output frame, features for the contrastive losses, carries of frame k
+        """
+        endecode_results_curr = []
+            
+        d_weight_mul = 1.0
+        if self.con_operator == params.square_and_square_root_manual_d:
+            d_weight_mul = x_frame[0, 1, 0, 0]
+        # print("d_weight_mul", d_weight_mul)
+        next_x = self.run_block(self.inc, x_frame)
+        x_results = [next_x]
+
+        endecode_results_curr.append(next_x[:,:int(next_x.shape[1]*self.recurrent_ch_ratio),:,:])
+        
+        for i, down_layer in enumerate(self.down_path):
+            if k==0:
+                fea = next_x
+            else:
+                #pass
+                #print(len(self.decode_results))
+                #print(self.depth)
+                #print(self.depth-i)
+                #print('--------')
+                #for j in range(len(self.decode_results)):
+                #    print(self.decode_results[j][:,:,2:-2,2:-2].shape)
+                #print('--------')
+                #next_x[:,:int(next_x.shape[1]*self.recurrent_ch_ratio),:,:] = next_x[:,:int(next_x.shape[1]*self.recurrent_ch_ratio),:,:]+self.decode_results[self.depth-i-1][:,:int(next_x.shape[1]*self.recurrent_ch_ratio),2:-2,2:-2].detach()
+                fea = torch.cat((endecode_results_last[i],next_x[:,int(next_x.shape[1]*self.recurrent_ch_ratio):,:,:]), 1)
+                #if i<2:
+                #    fea = torch.cat((next_x[:,:int(next_x.shape[1]*self.recurrent_ch_ratio),:,:]+self.decode_results[self.depth-i-1][:,:,2:-2,2:-2].detach(),next_x[:,int(next_x.shape[1]*self.recurrent_ch_ratio):,:,:]), 1)
+                #else:
+                #    fea = next_x
+            next_x = self.run_block(down_layer, fea)
+            x_results.append(next_x)
             endecode_results_curr.append(next_x[:,:int(next_x.shape[1]*self.recurrent_ch_ratio),:,:])
             
-            for i, down_layer in enumerate(self.down_path):
-                if k==0:
-                    fea = next_x
-                else:
-                    #pass
-                    #print(len(self.decode_results))
-                    #print(self.depth)
-                    #print(self.depth-i)
-                    #print('--------')
-                    #for j in range(len(self.decode_results)):
-                    #    print(self.decode_results[j][:,:,2:-2,2:-2].shape)
-                    #print('--------')
-                    #next_x[:,:int(next_x.shape[1]*self.recurrent_ch_ratio),:,:] = next_x[:,:int(next_x.shape[1]*self.recurrent_ch_ratio),:,:]+self.decode_results[self.depth-i-1][:,:int(next_x.shape[1]*self.recurrent_ch_ratio),2:-2,2:-2].detach()
-                    fea = torch.cat((endecode_results_last[i],next_x[:,int(next_x.shape[1]*self.recurrent_ch_ratio):,:,:]), 1)
-                    #if i<2:
-                    #    fea = torch.cat((next_x[:,:int(next_x.shape[1]*self.recurrent_ch_ratio),:,:]+self.decode_results[self.depth-i-1][:,:,2:-2,2:-2].detach(),next_x[:,int(next_x.shape[1]*self.recurrent_ch_ratio):,:,:]), 1)
-                    #else:
-                    #    fea = next_x
-                next_x = down_layer(fea)
-                x_results.append(next_x)
-                endecode_results_curr.append(next_x[:,:int(next_x.shape[1]*self.recurrent_ch_ratio),:,:])
-                
 
-            #print('..........')
-            #for j in range(len(x_results)):
-            #    print(x_results[j].shape)
-            #print('..........')
+        #print('..........')
+        #for j in range(len(x_results)):
+        #    print(x_results[j].shape)
+        #print('..........')
 
-            up_x = x_results[(self.depth)]
-            #print('--------')
-            #print(up_x.shape)
-            #print('--------')
-            up_x = self.gcn(up_x)
+        up_x = x_results[(self.depth)]
+        #print('--------')
+        #print(up_x.shape)
+        #print('--------')
+        up_x = self.run_block(self.gcn, up_x)
+        endecode_results_curr.append(up_x[:,:int(up_x.shape[1]*self.recurrent_ch_ratio),:,:])
+        
+        for i, up_layer in enumerate(self.up_path):
+            if k==0:
+                fea = up_x
+            else:
+                fea = torch.cat((endecode_results_last[len(self.down_path)+1+i],up_x[:,int(up_x.shape[1]*self.recurrent_ch_ratio):,:,:]), 1)
+            up_x = self.run_block(up_layer, fea, x_results[(self.depth - (i + 1))], self.con_operator,
+                                  self.network, d_weight_mul)
             endecode_results_curr.append(up_x[:,:int(up_x.shape[1]*self.recurrent_ch_ratio),:,:])
-            
-            for i, up_layer in enumerate(self.up_path):
-                if k==0:
-                    fea = up_x
-                else:
-                    fea = torch.cat((endecode_results_last[len(self.down_path)+1+i],up_x[:,int(up_x.shape[1]*self.recurrent_ch_ratio):,:,:]), 1)
-                up_x = up_layer(fea, x_results[(self.depth - (i + 1))], self.con_operator, self.network, d_weight_mul)
-                endecode_results_curr.append(up_x[:,:int(up_x.shape[1]*self.recurrent_ch_ratio),:,:])
 
-            fea1 = F.adaptive_avg_pool2d(up_x, (1,1))
-            fea2 = self.contrast_extracter(up_x)
-            fea2 = F.adaptive_avg_pool2d(fea2, (1,1))
-            fea_final = torch.cat([fea1, fea2], dim=1)
-            features.append(fea_final.unsqueeze(1))
-            
-            x_out = self.outc(up_x)
-            if self.last_sig is not None:
-                x_out = self.last_sig(x_out)
-            if apply_crop and self.to_crop:
-                x_out = data_loader_util.crop_input_hdr_batch(x_out, diffY=diffY, diffX=diffX)
-            output_results.append(x_out.unsqueeze(1))
-            endecode_results_last = endecode_results_curr.copy()
-        output_results = torch.cat(output_results, 1)
-        features = torch.cat(features, 1)
-        return output_results, features
+        fea1 = F.adaptive_avg_pool2d(up_x, (1,1))
+        fea2 = self.contrast_extracter(up_x)
+        fea2 = F.adaptive_avg_pool2d(fea2, (1,1))
+        fea_final = torch.cat([fea1, fea2], dim=1)
+        x_out = self.outc(up_x)
+        if self.last_sig is not None:
+            x_out = self.last_sig(x_out)
+        if apply_crop and self.to_crop:
+            x_out = data_loader_util.crop_input_hdr_batch(x_out, diffY=diffY, diffX=diffX)
+        return x_out, fea_final, endecode_results_curr
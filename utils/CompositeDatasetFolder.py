@@ -0,0 +1,103 @@
+import math
+
+import torch
+import torch.utils.data as data
+
+
+class CompositeDatasetFolder(data.Dataset):
+    """
+    hdr, ldr positive and ldr negative train sets behind one dataset, so a single DataLoader
+    (one worker pool, one collation) produces the three batches of a train step.
+    indexed by the (hdr, ldr_pos, ldr_neg) index triples drawn by TripletSampler.
+    """
+
+    def __init__(self, hdr_dataset, ldr_pos_dataset, ldr_neg_dataset):
+        self.hdr_dataset = hdr_dataset
+        self.ldr_pos_dataset = ldr_pos_dataset
+        self.ldr_neg_dataset = ldr_neg_dataset
+
+    def get_lengths(self):
+        return [len(self.hdr_dataset), len(self.ldr_pos_dataset), len(self.ldr_neg_dataset)]
+
+    def __getitem__(self, index):
+        hdr_index, ldr_pos_index, ldr_neg_index = index
+        return {"hdr": self.hdr_dataset[hdr_index],
+                "ldr_pos": self.ldr_pos_dataset[ldr_pos_index],
+                "ldr_neg": self.ldr_neg_dataset[ldr_neg_index]}
+
+    def __getitems__(self, indices):
+        # batched fetch (torch >= 2.0): streaming datasets start decoding the whole batch before it is built
+        for k, dataset in enumerate([self.hdr_dataset, self.ldr_pos_dataset, self.ldr_neg_dataset]):
+            if hasattr(dataset, "prefetch_indices"):
+                dataset.prefetch_indices([index[k] for index in indices])
+        return [self[index] for index in indices]
+
+    def __len__(self):
+        return len(self.hdr_dataset)
+
+
+class TripletSampler(data.Sampler):
+    """
+    draws (hdr, ldr_pos, ldr_neg) index triples.
+    every set is read as a stream of random permutations, so a set that is shorter than the epoch is
+    cycled instead of truncating it, and no path list has to be duplicated.
+    ratios[i] is the part of set i that one epoch goes through, the epoch length is the largest of them.
+    every epoch is drawn from a generator seeded by seed + epoch (see set_epoch), so a resumed run replays it
+    and skips the triples it already trained on (see set_start).
+    with num_replicas > 1 (distributed training) every process draws the same epoch and keeps every
+    num_replicas-th triple from "rank", the epoch is padded with its first triples so all processes run
+    the same number of steps.
+    """
+
+    def __init__(self, lengths, ratios, shuffle=True, num_replicas=1, rank=0, seed=0):
+        self.lengths = lengths
+        self.ratios = ratios
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+        self.total_samples = max(int(math.ceil(ratio * length)) for ratio, length in zip(ratios, lengths))
+        if self.total_samples == 0:
+            raise Exception("empty train epoch, check the sampling ratios %s and the train sets sizes %s"
+                            % (str(ratios), str(lengths)))
+        self.num_samples = int(math.ceil(self.total_samples / num_replicas))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start = 0
+
+    def set_start(self, start):
+        """
+        skip the first "start" triples of this process in the current epoch (resuming mid-epoch)
+        """
+        self.start = start
+
+    def index_stream(self, length, generator):
+        while True:
+            if self.shuffle:
+                indices = torch.randperm(length, generator=generator).tolist()
+            else:
+                indices = range(length)
+            for i in indices:
+                yield i
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        streams = [self.index_stream(length, generator) for length in self.lengths]
+        if self.num_replicas == 1:
+            for i in range(self.num_samples):
+                triple = tuple(next(stream) for stream in streams)
+                if i >= self.start:
+                    yield triple
+            return
+        triples = [tuple(next(stream) for stream in streams) for _ in range(self.total_samples)]
+        padding = self.num_samples * self.num_replicas - self.total_samples
+        triples += triples[:padding]
+        for triple in triples[self.rank::self.num_replicas][self.start:]:
+            yield triple
+
+    def __len__(self):
+        return max(self.num_samples - self.start, 0)
@@ -4,7 +4,7 @@ import numpy as np
 import torch
 from torchvision.datasets import DatasetFolder
 import torch.utils.data as data
-from utils import data_loader_util, hdr_image_util, params
+from utils import data_loader_util, hdr_image_util, lambda_index, log_luma_cache, params
 import torch.nn.functional as F
 import glob
 import random
@@ -25,59 +25,136 @@ def get_ldr_im(normalization, input_im, max_stretch, min_stretch):
 
 def get_f(f_dict_path, im_name, factor_coeff):
     # use_hist_fit true by default
-    data = np.load(f_dict_path, allow_pickle=True)
-    if im_name in data[()]:
-        f_factor = data[()][im_name]
-        brightness_factor = f_factor * 255 * factor_coeff
-    else:
-        # TODO: add the option to calculate f here
-        raise Exception("no lambda found for file %s in %s" % (im_name, f_dict_path))
+    f_factor = lambda_index.get_lambda(f_dict_path, im_name)
+    brightness_factor = f_factor * 255 * factor_coeff
     return brightness_factor
 
 def preprocess(raw):
     input_full = raw.transpose((0, 3, 1, 2))
-    input_full = torch.from_numpy(input_full)
-    input_full = input_full.cuda()
+    # stays on cpu, so the sample can be built in a DataLoader worker; the trainer moves the batch to the device
+    input_full = torch.from_numpy(np.ascontiguousarray(input_full))
     return input_full
 
+def get_resize_crop_window(h, w, patch_h=256, max_resize_h=512):
+    """
+    draw the random resize + crop used for training patches, expressed as a window of the source image.
+    resizing the returned window to (patch_h, patch_h) gives the same patch as resizing the whole image
+    to a random size and cropping it.
+    """
+    mode = np.random.randint(0,2)
+    if mode==0:
+        resize_h = patch_h
+    else:
+        resize_h = int(np.random.uniform(patch_h,max_resize_h))
+    if resize_h==patch_h:
+        return 0, h, 0, w
+    xx = np.random.randint(0, resize_h - patch_h)
+    yy = np.random.randint(0, resize_h - patch_h)
+    scale_y, scale_x = h / resize_h, w / resize_h
+    y0, x0 = int(round(yy * scale_y)), int(round(xx * scale_x))
+    y1, x1 = min(h, int(round((yy + patch_h) * scale_y))), min(w, int(round((xx + patch_h) * scale_x)))
+    return y0, y1, x0, x1
+
+def load_npy(path, npy_mmap=False, store=None):
+    """
+    load a training array from its .npy file, or from the packed shards when a ShardStore is given
+    (the path is then a manifest key).
+    """
+    if store is not None:
+        return store.load(path)
+    if npy_mmap:
+        return np.load(path, mmap_mode='r')
+    return np.load(path, allow_pickle=True)
+
+def read_npy_patch(path, always_resize, patch_h=256, store=None, data=None):
+    """
+    read a single training crop from a patch .npy file.
+    the file is memory mapped and only the rows/cols of the crop window are copied out of it,
+    instead of decoding the whole array.
+    :param data: the already opened memory map of the file, a new random crop window is still drawn
+    """
+    if data is None:
+        data = load_npy(path, npy_mmap=True, store=store)
+    h, w = data.shape[0], data.shape[1]
+    if not always_resize and h==patch_h:
+        return np.array(data, dtype=np.float32)
+    y0, y1, x0, x1 = get_resize_crop_window(h, w, patch_h)
+    color_im = np.array(data[y0:y1, x0:x1, :], dtype=np.float32)
+    if color_im.shape[0]!=patch_h or color_im.shape[1]!=patch_h:
+        color_im = cv2.resize(color_im, (patch_h, patch_h))
+    return color_im
+
+def read_log_luma_patch(path, brightness_factor, npy_mmap=False, patch_h=256):
+    """
+    hdr training crop cut together with the cached gray / log10 maps of its source patch (utils/log_luma_cache),
+    only the per-crop normalisations are left to compute.
+    :return: input_im, color_im, gray_original_im_norm, gray_original_im tensors of the crop
+    """
+    data = load_npy(path, npy_mmap)
+    maps = log_luma_cache.load_log_luma(path, data, brightness_factor)
+    h, w = data.shape[0], data.shape[1]
+    if h==patch_h:
+        y0, y1, x0, x1 = 0, h, 0, w
+    else:
+        y0, y1, x0, x1 = get_resize_crop_window(h, w, patch_h)
+    im = np.concatenate([np.asarray(data[y0:y1, x0:x1, :], dtype=np.float32),
+                         np.asarray(maps[y0:y1, x0:x1, :], dtype=np.float32)], axis=2)
+    if im.shape[0]!=patch_h or im.shape[1]!=patch_h:
+        im = cv2.resize(im, (patch_h, patch_h))
+    im = preprocess(np.expand_dims(im, 0))[0]
+    color_im = im[:3]
+    gray_original_im = im[3:4]
+    gray_original_im_norm = gray_original_im / gray_original_im.max()
+    gray_original_im = gray_original_im - gray_original_im.min()
+    input_im = im[4:5] / im[4:5].max()
+    return input_im, color_im, gray_original_im_norm, gray_original_im
+
 def npy_loader(path, addFrame, hdrMode, ldrNegMode, normalization, min_stretch,
                max_stretch, factor_coeff, use_contrast_ratio_f, use_hist_fit, f_dict_path,
-               final_shape_addition, real_video):
+               final_shape_addition, real_video, npy_mmap=False, store=None, log_cache=False):
     """
     load npy files that contain the loaded HDR file, and binary image of windows centers.
-
+    with npy_mmap the patch file is memory mapped once, and every frame copies only its own
+    random crop window out of it.
+    with a ShardStore, "path" is a manifest key and the arrays are read from the packed shards.
+    with log_cache, hdr image crops are cut out of the cached log10 maps of their npy file (see read_log_luma_patch).
     """
     print('process image data')
     #print(real_video)
+    # the frames of a patch sample share one memory map of its file
+    mmap_data = load_npy(path, True, store) if npy_mmap and not real_video else None
     if ldrNegMode:
         input_im_frames = []
         color_im_frames = []
         gray_original_im_norm_frames = []
         gray_original_im_frames = []
         for k in range(2):
-            data = np.load(path, allow_pickle=True)
-            color_im = data
-            color_im = color_im.astype(np.float32)
-
-            mode = np.random.randint(0,2)
-            if mode==0:
-                resize_h = 256
-            else:
-                resize_h = int(np.random.uniform(256,512))
-            resize_w = resize_h
-            color_im = cv2.resize(color_im, (resize_w, resize_h))
-            
-            patch_h = 256
-            patch_w = patch_h
-            h = color_im.shape[0]
-            w = color_im.shape[1]
-            if h==patch_h:
-                pass
+            if npy_mmap:
+                color_im = read_npy_patch(path, always_resize=True, data=mmap_data)
             else:
-                xx = np.random.randint(0, w - patch_w) 
-                yy = np.random.randint(0, h - patch_h)
-                color_im = color_im[yy:yy+patch_h,xx:xx+patch_w,:]
-            
+                data = load_npy(path, store=store)
+                color_im = data
+                color_im = color_im.astype(np.float32)
+
+                mode = np.random.randint(0,2)
+                if mode==0:
+                    resize_h = 256
+                else:
+                    resize_h = int(np.random.uniform(256,512))
+                resize_w = resize_h
+                color_im = cv2.resize(color_im, (resize_w, resize_h))
+
+                patch_h = 256
+                patch_w = patch_h
+                h = color_im.shape[0]
+                w = color_im.shape[1]
+                if h==patch_h:
+                    pass
+                else:
+                    xx = np.random.randint(0, w - patch_w)
+                    yy = np.random.randint(0, h - patch_h)
+                    color_im = color_im[yy:yy+patch_h,xx:xx+patch_w,:]
+
             yuv_im = cv2.cvtColor(color_im, cv2.COLOR_RGB2YUV)
             input_im = yuv_im[:,:,:1]
             color_im = preprocess(np.expand_dims(color_im, 0))[0]
@@ -100,33 +177,48 @@ def npy_loader(path, addFrame, hdrMode, ldrNegMode, normalization, min_stretch,
             gray_original_im_norm_frames = []
             gray_original_im_frames = []
             for k in range(2):
-                data = np.load(path, allow_pickle=True)
-                #input_im = data[()]["input_image"]
-                #color_im = data[()]["display_image"]
-                color_im = data
-                #input_im = input_im.astype(np.float32)
-                color_im = color_im.astype(np.float32)
-                if color_im.shape[0]==256:
-                    pass
+                if hdrMode and log_cache and store is None:
+                    im_name = os.path.splitext(os.path.basename(path))[0]
+                    brightness_factor = get_f(f_dict_path, im_name, factor_coeff)
+                    input_im, color_im, gray_original_im_norm, gray_original_im = \
+                        read_log_luma_patch(path, brightness_factor, npy_mmap)
+                    if addFrame:
+                        input_im = data_loader_util.add_frame_to_im(input_im, final_shape_addition, final_shape_addition)
+                    input_im_frames.append(input_im.unsqueeze(0))
+                    color_im_frames.append(color_im.unsqueeze(0))
+                    gray_original_im_norm_frames.append(gray_original_im_norm.unsqueeze(0))
+                    gray_original_im_frames.append(gray_original_im.unsqueeze(0))
+                    continue
+                if npy_mmap:
+                    color_im = read_npy_patch(path, always_resize=False, data=mmap_data)
                 else:
-                    mode = np.random.randint(0,2)
-                    if mode==0:
-                        resize_h = 256
+                    data = load_npy(path, store=store)
+                    #input_im = data[()]["input_image"]
+                    #color_im = data[()]["display_image"]
+                    color_im = data
+                    #input_im = input_im.astype(np.float32)
+                    color_im = color_im.astype(np.float32)
+                    if color_im.shape[0]==256:
+                        pass
                     else:
-                        resize_h = int(np.random.uniform(256,512))
-                    resize_w = resize_h
-                    color_im = cv2.resize(color_im, (resize_w, resize_h))
-                patch_h = 256
-                patch_w = patch_h
-                h = color_im.shape[0]
-                w = color_im.shape[1]
-                if h==patch_h:
-                    pass
-                else:
-                    xx = np.random.randint(0, w - patch_w) 
-                    yy = np.random.randint(0, h - patch_h)
-                    color_im = color_im[yy:yy+patch_h,xx:xx+patch_w,:]
-                
+                        mode = np.random.randint(0,2)
+                        if mode==0:
+                            resize_h = 256
+                        else:
+                            resize_h = int(np.random.uniform(256,512))
+                        resize_w = resize_h
+                        color_im = cv2.resize(color_im, (resize_w, resize_h))
+                    patch_h = 256
+                    patch_w = patch_h
+                    h = color_im.shape[0]
+                    w = color_im.shape[1]
+                    if h==patch_h:
+                        pass
+                    else:
+                        xx = np.random.randint(0, w - patch_w)
+                        yy = np.random.randint(0, h - patch_h)
+                        color_im = color_im[yy:yy+patch_h,xx:xx+patch_w,:]
+
                 yuv_im = cv2.cvtColor(color_im, cv2.COLOR_RGB2YUV)
                 input_im = yuv_im[:,:,:1]
                 color_im = preprocess(np.expand_dims(color_im, 0))[0]
@@ -167,6 +259,42 @@ def npy_loader(path, addFrame, hdrMode, ldrNegMode, normalization, min_stretch,
                 return input_im_frames.float(), color_im_frames.float(), gray_original_im_norm_frames.float(), gray_original_im_frames.float(), brightness_factor
 
 
+def put_on_canvas(color_im, raw_size):
+    """
+    place a patch that must not be rescaled in the top-left corner of a raw_size x raw_size canvas,
+    batch_augment samples that corner exactly.
+    """
+    canvas = np.zeros((raw_size, raw_size, color_im.shape[2]), dtype=np.float32)
+    canvas[:color_im.shape[0], :color_im.shape[1], :] = color_im
+    return canvas
+
+def npy_raw_loader(path, hdrMode, ldrNegMode, factor_coeff, f_dict_path, real_video, raw_size,
+                   npy_mmap=False, store=None):
+    """
+    load the raw rgb frames of a sample for utils/batch_augment, each resized to raw_size x raw_size.
+    random scale, crop, luma and normalisation are applied later on the whole batch.
+    :return: raw frames (2, 3, raw_size, raw_size), size of the fixed top-left window of each frame
+             (0 for a random scale + crop), brightness factor (0 for ldr)
+    """
+    raw_frames = []
+    fixed_sizes = []
+    brightness_factor = 0
+    if ldrNegMode or not real_video:
+        # both frames are random crops of the same image, so it is read once
+        color_im = load_npy(path, npy_mmap, store).astype(np.float32)
+        if not ldrNegMode and color_im.shape[0]==256:
+            color_im, fixed_size = put_on_canvas(color_im, raw_size), 256
+        else:
+            if color_im.shape[0]!=raw_size or color_im.shape[1]!=raw_size:
+                color_im = cv2.resize(color_im, (raw_size, raw_size))
+            fixed_size = 0
+        raw_frames = [color_im, color_im]
+        fixed_sizes = [fixed_size, fixed_size]
+        if hdrMode and not ldrNegMode:
+            brightness_factor = get_f(f_dict_path, os.path.splitext(os.path.basename(path))[0], factor_coeff)
+    raw_frames = preprocess(np.stack(raw_frames, 0))
+    return raw_frames, torch.tensor(fixed_sizes), brightness_factor
+
 #class ProcessedDatasetFolder(DatasetFolder):
 class ProcessedDatasetFolder(data.Dataset):
     """
@@ -190,12 +318,17 @@ class ProcessedDatasetFolder(data.Dataset):
         self.use_hist_fit = dataset_properties["use_hist_fit"]
         self.f_train_dict_path = dataset_properties["f_train_dict_path"]
         self.final_shape_addition = dataset_properties["final_shape_addition"]
-        self.hdr_video_path = glob.glob('../../data/tone_mapping/train_HDRvideo/*/*.npy')
-        self.srgb_video_path = glob.glob('../../data/tone_mapping/train_sRGBvideo/*/*.npy')
+        self.npy_mmap = dataset_properties["npy_mmap"]
+        self.log_cache = dataset_properties["log_luma_cache"]
+        # raw samples for utils/batch_augment
+        self.raw_size = dataset_properties["augment_raw_size"] if dataset_properties["batch_augment"] else 0
         self.f_train_hdrvideo_dict_path = "data/input_images_lambdas_trainHDRvideo.npy"
-        self.negative_ldr_path = glob.glob('../../data/tone_mapping/SICE_patches512_npy/*.npy')
-        for _ in range(3):
-            self.negative_ldr_path = self.negative_ldr_path + self.negative_ldr_path
+        self.store = None
+        self.load_paths()
+        if self.hdrMode:
+            # load the lambda tables once here, so DataLoader workers inherit them instead of re-reading per sample
+            for f_dict_path in [self.f_train_dict_path]:
+                lambda_index.get_lambda_index(f_dict_path)
         #print('negative ldr paths:{}'.format(self.negative_ldr_path))
         #print('.............')
         #print(len(self.imgs))
@@ -204,6 +337,11 @@ class ProcessedDatasetFolder(data.Dataset):
         #print('.............')
         
 
+    def load_paths(self):
+        self.hdr_video_path = glob.glob('../../data/tone_mapping/train_HDRvideo/*/*.npy')
+        self.srgb_video_path = glob.glob('../../data/tone_mapping/train_sRGBvideo/*/*.npy')
+        self.negative_ldr_path = glob.glob('../../data/tone_mapping/SICE_patches512_npy/*.npy')
+
     def __getitem__(self, index):
         """
         Args:
@@ -232,6 +370,11 @@ class ProcessedDatasetFolder(data.Dataset):
                 f_train_dict_path = self.f_train_hdrvideo_dict_path
                 real_video = True
         #print(real_video)
+        if self.raw_size:
+            raw_im, fixed_size, gamma_factor = npy_raw_loader(path, self.hdrMode, self.ldrNegMode, self.factor_coeff,
+                                                              f_train_dict_path, real_video, self.raw_size,
+                                                              npy_mmap=self.npy_mmap, store=self.store)
+            return {"raw_im": raw_im, "fixed_size": fixed_size, "gamma_factor": gamma_factor}
         input_im, color_im, gray_original_norm, gray_original, gamma_factor = self.loader(path, self.addFrame,
                                                                                           self.hdrMode,
                                                                                           self.ldrNegMode,
@@ -243,7 +386,10 @@ class ProcessedDatasetFolder(data.Dataset):
                                                                                           self.use_hist_fit,
                                                                                           f_train_dict_path,
                                                                                           self.final_shape_addition,
-                                                                                          real_video=real_video)
+                                                                                          real_video=real_video,
+                                                                                          npy_mmap=self.npy_mmap,
+                                                                                          log_cache=self.log_cache,
+                                                                                          store=self.store)
         #print('......')
         #print(input_im.shape)
         #print(color_im.shape)
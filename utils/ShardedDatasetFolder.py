@@ -0,0 +1,45 @@
+from utils import ProcessedDatasetFolder, ProcessedDatasetFolderImg, shard_util
+
+
+def load_shard_paths(dataset):
+    """
+    fill the path lists of "dataset" with manifest keys instead of globbing the .npy folders.
+    """
+    dataset.store = shard_util.ShardStore(dataset.shards_dir)
+    if dataset.hdrMode:
+        dataset.imgs = dataset.store.get_keys("hdr")
+    else:
+        dataset.imgs = dataset.store.get_keys("ldr")
+    dataset.hdr_video_path = dataset.store.get_keys("hdr_video")
+    dataset.srgb_video_path = dataset.store.get_keys("srgb_video")
+    dataset.negative_ldr_path = dataset.store.get_keys("neg")
+
+
+class ShardedDatasetFolder(ProcessedDatasetFolder.ProcessedDatasetFolder):
+    """
+    video training set read from the shards written by utils/shard_util.py,
+    samples are the same as ProcessedDatasetFolder.
+    """
+
+    def __init__(self, shards_dir, dataset_properties, hdrMode, ldrNegMode):
+        self.shards_dir = shards_dir
+        super(ShardedDatasetFolder, self).__init__(root=None, dataset_properties=dataset_properties,
+                                                   hdrMode=hdrMode, ldrNegMode=ldrNegMode)
+
+    def load_paths(self):
+        load_shard_paths(self)
+
+
+class ShardedDatasetFolderImg(ProcessedDatasetFolderImg.ProcessedDatasetFolder):
+    """
+    image training set read from the shards written by utils/shard_util.py,
+    samples are the same as ProcessedDatasetFolderImg.
+    """
+
+    def __init__(self, shards_dir, dataset_properties, hdrMode, ldrNegMode):
+        self.shards_dir = shards_dir
+        super(ShardedDatasetFolderImg, self).__init__(root=None, dataset_properties=dataset_properties,
+                                                      hdrMode=hdrMode, ldrNegMode=ldrNegMode)
+
+    def load_paths(self):
+        load_shard_paths(self)
@@ -0,0 +1,216 @@
+import collections
+import glob
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from utils import ProcessedDatasetFolder, ProcessedDatasetFolderImg, hdr_image_util, lambda_index
+
+HDR_EXTENSIONS = ('.exr', '.hdr', '.dng')
+LDR_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def list_source_files(root, extensions):
+    """
+    files of "root" with one of "extensions", in any letter case (listed once, also on case-insensitive filesystems)
+    """
+    files = [path for path in glob.glob(os.path.join(root, '*'))
+             if os.path.splitext(path)[1].lower() in extensions and os.path.isfile(path)]
+    return sorted(files)
+
+
+def decode_image(path, image_size):
+    """
+    read an original hdr (.exr/.hdr/.dng) or ldr (.png/.jpg) image and downscale it so that its
+    short side is at most image_size.
+    """
+    if os.path.splitext(path)[1].lower() in LDR_EXTENSIONS:
+        im = hdr_image_util.read_ldr_image_original_range(path).astype(np.float32)
+    else:
+        im = hdr_image_util.read_hdr_image(path)
+    if im.ndim == 2:
+        im = np.stack([im, im, im], axis=-1)
+    im = im[:, :, :3]
+    if np.min(im) < 0:
+        im = im - np.min(im)
+    h, w = im.shape[0], im.shape[1]
+    scale = image_size / min(h, w)
+    if scale < 1:
+        im = cv2.resize(im, (int(round(w * scale)), int(round(h * scale))), interpolation=cv2.INTER_AREA)
+    return np.ascontiguousarray(im, dtype=np.float32)
+
+
+class ImageCache:
+    """
+    thread-safe LRU cache of decoded images, bounded by their total size in bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.images = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.images
+
+    def get(self, key):
+        with self.lock:
+            im = self.images.get(key)
+            if im is not None:
+                self.images.move_to_end(key)
+            return im
+
+    def put(self, key, im):
+        with self.lock:
+            if key in self.images:
+                return
+            self.images[key] = im
+            self.size += im.nbytes
+            while self.size > self.max_bytes and len(self.images) > 1:
+                _, old_im = self.images.popitem(last=False)
+                self.size -= old_im.nbytes
+
+
+class StreamStore:
+    """
+    array source for npy_loader (see ProcessedDatasetFolder.load_npy) that reads original hdr/ldr images.
+    images are decoded by a thread pool, kept downscaled in an LRU cache, and every load cuts a new
+    random patch_size patch out of the cached image, like the offline npy patches.
+    the pool and the cache belong to the process, each DataLoader worker builds its own.
+    """
+
+    def __init__(self, image_size=1024, patch_size=512, cache_mb=4096, threads=4):
+        self.image_size = image_size
+        self.patch_size = patch_size
+        self.cache_mb = cache_mb
+        self.threads = threads
+        self.init_process_state()
+
+    def init_process_state(self):
+        self.cache = ImageCache(self.cache_mb * 1024 * 1024)
+        self.pool = None
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ["cache", "pool", "pending", "lock"]:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.init_process_state()
+
+    def __contains__(self, path):
+        return os.path.exists(path)
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        return self.pool
+
+    def prefetch(self, paths):
+        """
+        start decoding the images in "paths" in the background.
+        """
+        with self.lock:
+            for path in paths:
+                if os.path.splitext(path)[1] == ".npy" or path in self.pending or path in self.cache:
+                    continue
+                self.pending[path] = self.get_pool().submit(decode_image, path, self.image_size)
+
+    def get_image(self, path):
+        im = self.cache.get(path)
+        if im is not None:
+            return im
+        with self.lock:
+            future = self.pending.pop(path, None)
+        if future is not None:
+            im = future.result()
+        else:
+            im = decode_image(path, self.image_size)
+        self.cache.put(path, im)
+        return im
+
+    def load(self, path):
+        if os.path.splitext(path)[1] == ".npy":
+            # video frames and negatives that are still read from npy files
+            return np.load(path, mmap_mode='r')
+        im = self.get_image(path)
+        h, w = im.shape[0], im.shape[1]
+        patch_size = min(self.patch_size, h, w)
+        yy = np.random.randint(0, h - patch_size + 1)
+        xx = np.random.randint(0, w - patch_size + 1)
+        return im[yy:yy + patch_size, xx:xx + patch_size, :]
+
+
+def set_stream_lambdas(dataset, dataset_properties):
+    """
+    streamed hdr images look their lambda up by the name of their original file (not of an npy patch):
+    use the stream_lambda_path table when given, and check that every image has a lambda before training.
+    """
+    if not dataset.hdrMode or dataset.ldrNegMode:
+        return
+    if dataset_properties["stream_lambda_path"]:
+        dataset.f_train_dict_path = dataset_properties["stream_lambda_path"]
+    index = lambda_index.get_lambda_index(dataset.f_train_dict_path)
+    names = [os.path.splitext(os.path.basename(path))[0] for path in dataset.imgs]
+    missing = [name for name in names if name not in index]
+    if missing:
+        raise Exception("no lambda found in %s for %d of the streamed hdr images: %s%s, "
+                        "set --stream_lambda_path to a table keyed by the original file names"
+                        % (dataset.f_train_dict_path, len(missing), ", ".join(missing[:10]),
+                           ", ..." if len(missing) > 10 else ""))
+
+
+def prefetch_indices(dataset, indices):
+    if dataset.ldrNegMode:
+        paths = [dataset.negative_ldr_path[i] for i in indices]
+    else:
+        paths = [dataset.imgs[i] for i in indices]
+    dataset.stream_store.prefetch(paths)
+
+
+class StreamingDatasetFolder(ProcessedDatasetFolder.ProcessedDatasetFolder):
+    """
+    video training set whose hdr / ldr images ("root") are original image files read through a StreamStore,
+    the video frames and negatives are still read from their npy folders.
+    """
+
+    def __init__(self, root, dataset_properties, hdrMode, ldrNegMode, stream_store):
+        self.stream_store = stream_store
+        super(StreamingDatasetFolder, self).__init__(root=root, dataset_properties=dataset_properties,
+                                                     hdrMode=hdrMode, ldrNegMode=ldrNegMode)
+        set_stream_lambdas(self, dataset_properties)
+
+    def load_paths(self):
+        super(StreamingDatasetFolder, self).load_paths()
+        self.store = self.stream_store
+
+    def prefetch_indices(self, indices):
+        prefetch_indices(self, indices)
+
+
+class StreamingDatasetFolderImg(ProcessedDatasetFolderImg.ProcessedDatasetFolder):
+    """
+    image training set whose hdr / ldr images ("root") are original image files read through a StreamStore.
+    """
+
+    def __init__(self, root, dataset_properties, hdrMode, ldrNegMode, stream_store):
+        self.stream_store = stream_store
+        super(StreamingDatasetFolderImg, self).__init__(root=root, dataset_properties=dataset_properties,
+                                                        hdrMode=hdrMode, ldrNegMode=ldrNegMode)
+        set_stream_lambdas(self, dataset_properties)
+
+    def load_paths(self):
+        super(StreamingDatasetFolderImg, self).load_paths()
+        self.store = self.stream_store
+
+    def prefetch_indices(self, indices):
+        prefetch_indices(self, indices)
@@ -2,6 +2,7 @@ import scipy.optimize as optimize
 import numpy as np
 import os
 import utils.hdr_image_util as hdr_image_util
+import utils.lambda_index as lambda_index
 
 
 def cross_entropy(factor, gray_im, targets, bins_):
@@ -63,5 +64,6 @@ def calc_lambda(f_factor_path, extensions, input_images_path, mean_hist_path, la
             #    sol.x[0]=50
             res_dict[os.path.splitext(img_name)[0]] = sol.x[0]
             np.save(lambdas_output_path, res_dict)
+    lambda_index.forget(lambdas_output_path)
     print("Lambdas data saved successfully")
     return lambdas_output_path
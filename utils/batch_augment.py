@@ -0,0 +1,105 @@
+import torch
+import torch.nn.functional as F
+
+from utils import data_loader_util, params
+
+
+def get_crop_theta(fixed_size, raw_size, patch_size=256, max_resize_h=512):
+    """
+    draw the random resize + crop of every frame at once, as affine_grid parameters over the raw frame.
+    frames with fixed_size > 0 take their top-left fixed_size window instead (already cropped patches).
+    same distribution as the cv2 pipeline: resize to 256 or uniform(256, 512), then a random 256 crop.
+    """
+    n = fixed_size.shape[0]
+    device = fixed_size.device
+    resize_h = torch.where(torch.rand(n, device=device) < 0.5,
+                           torch.full((n,), float(patch_size), device=device),
+                           torch.floor(patch_size + torch.rand(n, device=device) * (max_resize_h - patch_size)))
+    win = raw_size * patch_size / resize_h
+    fixed = fixed_size > 0
+    win = torch.where(fixed, fixed_size.float(), win)
+    y0 = torch.where(fixed, torch.zeros_like(win), torch.rand(n, device=device) * (raw_size - win))
+    x0 = torch.where(fixed, torch.zeros_like(win), torch.rand(n, device=device) * (raw_size - win))
+    theta = torch.zeros(n, 2, 3, device=device)
+    theta[:, 0, 0] = win / raw_size
+    theta[:, 1, 1] = win / raw_size
+    theta[:, 0, 2] = (x0 + win / 2) / raw_size * 2 - 1
+    theta[:, 1, 2] = (y0 + win / 2) / raw_size * 2 - 1
+    return theta
+
+
+def crop_resize_batch(raw_im, fixed_size, patch_size=256):
+    """
+    :param raw_im: (N, C, raw_size, raw_size)
+    :return: (N, C, patch_size, patch_size) random scaled crops, bilinear like cv2.INTER_LINEAR
+    """
+    theta = get_crop_theta(fixed_size, raw_im.shape[-1], patch_size)
+    grid = F.affine_grid(theta, [raw_im.shape[0], raw_im.shape[1], patch_size, patch_size], align_corners=False)
+    return F.grid_sample(raw_im, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+
+def to_luma(color_im):
+    # Y of cv2.COLOR_RGB2YUV / hdr_image_util.to_gray_tensor
+    return 0.299 * color_im[:, 0:1] + 0.587 * color_im[:, 1:2] + 0.114 * color_im[:, 2:3]
+
+
+def frame_max(im):
+    return im.amax(dim=(1, 2, 3), keepdim=True)
+
+
+def frame_min(im):
+    return im.amin(dim=(1, 2, 3), keepdim=True)
+
+
+class BatchAugment:
+    """
+    batched replacement of the per-sample cv2 augmentation of npy_loader.
+    the datasets return raw frames ("batch_augment" mode), this moves them to the device and applies
+    random scale, crop, luma, ldr normalisation and the hdr log10(x * f + 1) mapping to the whole batch.
+    the output dict has the same keys and shapes as the npy_loader samples.
+    """
+
+    def __init__(self, dataset_properties, device):
+        self.device = device
+        self.normalization = dataset_properties["normalization"]
+        self.max_stretch = dataset_properties["max_stretch"]
+        self.min_stretch = dataset_properties["min_stretch"]
+        self.add_frame = dataset_properties["add_frame"]
+        self.final_shape_addition = dataset_properties["final_shape_addition"]
+
+    def get_ldr_im(self, input_im):
+        if self.normalization == "max_normalization":
+            input_im = input_im / frame_max(input_im)
+        elif self.normalization == "bugy_max_normalization":
+            input_im = input_im / 255
+        elif self.normalization == "stretch":
+            input_im = ((input_im - frame_min(input_im)) / frame_max(input_im)) * self.max_stretch - self.min_stretch
+            input_im = input_im.clamp(0, 1)
+        return input_im
+
+    def __call__(self, data, hdrMode):
+        raw_im = data["raw_im"].to(self.device, non_blocking=True)
+        fixed_size = data["fixed_size"].to(self.device, non_blocking=True)
+        b, t = raw_im.shape[0], raw_im.shape[1]
+        color_im = crop_resize_batch(raw_im.reshape(b * t, *raw_im.shape[2:]), fixed_size.reshape(-1))
+        gray_im = to_luma(color_im)
+        if not hdrMode:
+            input_im = self.get_ldr_im(gray_im).reshape(b, t, *gray_im.shape[1:])
+            color_im = color_im.reshape(b, t, *color_im.shape[1:])
+            return {params.gray_input_image_key: input_im, params.color_image_key: color_im,
+                    params.original_gray_norm_key: input_im, params.original_gray_key: input_im,
+                    params.gamma_factor: data["gamma_factor"]}
+        brightness_factor = data["gamma_factor"].to(self.device, non_blocking=True).float()
+        brightness_factor = brightness_factor.repeat_interleave(t).view(-1, 1, 1, 1)
+        gray_original_im_norm = gray_im / frame_max(gray_im)
+        gray_original_im = gray_im - frame_min(gray_im)
+        a = torch.log10((gray_original_im / frame_max(gray_original_im)) * brightness_factor + 1)
+        input_im = a / frame_max(a)
+        if self.add_frame:
+            input_im = data_loader_util.add_frame_to_im_batch(input_im, self.final_shape_addition,
+                                                              self.final_shape_addition)
+        return {params.gray_input_image_key: input_im.reshape(b, t, *input_im.shape[1:]),
+                params.color_image_key: color_im.reshape(b, t, *color_im.shape[1:]),
+                params.original_gray_norm_key: gray_original_im_norm.reshape(b, t, *gray_im.shape[1:]),
+                params.original_gray_key: gray_original_im.reshape(b, t, *gray_im.shape[1:]),
+                params.gamma_factor: data["gamma_factor"]}
@@ -0,0 +1,227 @@
+import json
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+BEST_RECORD_NAME = "best.json"
+
+
+def snapshot_state(obj):
+    """
+    copy of a (nested) state dict with every tensor copied to cpu memory,
+    so training can go on changing the weights while the copy is written.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_state(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_state(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    """
+    torch.save to a temporary file next to "path", then rename it, so "path" is either the previous
+    file or the complete new one, never a truncated .pth.
+    """
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def atomic_save_json(obj, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def find_latest_checkpoint(path):
+    """
+    :param path: checkpoint file, or folder of checkpoints (the most recently written one is returned)
+    """
+    if os.path.isfile(path):
+        return path
+    names = [name for name in os.listdir(path) if name.endswith(".pth")] if os.path.isdir(path) else []
+    if not names:
+        raise Exception("no checkpoint to resume from in %s" % path)
+    return max((os.path.join(path, name) for name in names), key=os.path.getmtime)
+
+
+def get_rng_state(device):
+    """
+    torch / cuda / numpy / python random generator states, as tensors and python values
+    (no numpy arrays, so the checkpoint also loads with torch.load(weights_only=True))
+    """
+    numpy_state = np.random.get_state()
+    state = {"torch": torch.get_rng_state(),
+             "numpy": (numpy_state[0], numpy_state[1].tolist()) + tuple(numpy_state[2:]),
+             "python": random.getstate()}
+    if device.type == "cuda":
+        state["cuda"] = torch.cuda.get_rng_state(device)
+    return state
+
+
+def set_rng_state(state, device):
+    torch.set_rng_state(state["torch"].cpu())
+    numpy_state = state["numpy"]
+    np.random.set_state((numpy_state[0], np.array(numpy_state[1], dtype=np.uint32)) + tuple(numpy_state[2:]))
+    python_state = state["python"]
+    random.setstate((python_state[0], tuple(python_state[1]), python_state[2]))
+    if "cuda" in state and device.type == "cuda":
+        torch.cuda.set_rng_state(state["cuda"].cpu(), device)
+
+
+class CheckpointWriter:
+    """
+    writes checkpoints to "save_dir" from a background thread.
+    save() only copies the state to cpu memory, the disk write happens while training goes on
+    (save() waits when max_pending snapshots are already queued).
+    only the keep_last most recent checkpoints are kept, plus the best one by the tracked metric,
+    whose name and value are recorded in best.json.
+    """
+
+    def __init__(self, save_dir, keep_last=5, metric_mode="max", max_pending=2, use_thread=True):
+        if metric_mode not in ["max", "min"]:
+            raise Exception("unknown checkpoint metric mode %s, use max/min" % metric_mode)
+        self.save_dir = save_dir
+        self.keep_last = keep_last
+        self.metric_mode = metric_mode
+        self.recent = []
+        self.best_name, self.best_metric = None, None
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = None
+        if use_thread:
+            self.thread = threading.Thread(target=self.write_loop, name="checkpoint_writer", daemon=True)
+            self.thread.start()
+
+    def is_better(self, metric):
+        if metric is None:
+            return False
+        if self.best_metric is None:
+            return True
+        if self.metric_mode == "max":
+            return metric > self.best_metric
+        return metric < self.best_metric
+
+    def save(self, state, name, metric=None):
+        """
+        :param state: dict of state dicts / values, snapshotted before returning
+        :param name: file name of the checkpoint in save_dir
+        :param metric: value tracked for the best checkpoint, None if not evaluated
+        """
+        self.raise_error()
+        if metric is not None:
+            metric = float(metric)
+        self.run(self.write, snapshot_state(state), name, metric)
+
+    def set_metric(self, name, metric):
+        """
+        metric of a checkpoint saved before it was evaluated (see EvalWorker),
+        applied after the writes already queued.
+        """
+        self.raise_error()
+        self.run(self.update_best, name, float(metric))
+
+    def restore(self):
+        """
+        take over the checkpoints already in save_dir (resumed run): they are rotated with the new ones,
+        and the best recorded in best.json stays the best until a better one is saved.
+        """
+        if not os.path.isdir(self.save_dir):
+            return
+        names = [name for name in os.listdir(self.save_dir) if name.endswith(".pth")]
+        self.recent = sorted(names, key=lambda name: os.path.getmtime(os.path.join(self.save_dir, name)))
+        record_path = os.path.join(self.save_dir, BEST_RECORD_NAME)
+        if os.path.exists(record_path):
+            with open(record_path) as f:
+                record = json.load(f)
+            if record["name"] in names:
+                self.best_name, self.best_metric = record["name"], record["metric"]
+        print("%d checkpoints in %s, best %s" % (len(self.recent), self.save_dir, str(self.best_name)))
+
+    def run(self, *job):
+        if self.thread is None:
+            job[0](*job[1:])
+        else:
+            self.queue.put(job)
+
+    def write_loop(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is not None and self.error is None:
+                    job[0](*job[1:])
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+            if job is None:
+                return
+
+    def write(self, state, name, metric):
+        atomic_save(state, os.path.join(self.save_dir, name))
+        if name in self.recent:
+            self.recent.remove(name)
+        self.recent.append(name)
+        self.update_best(name, metric)
+        self.rotate()
+
+    def update_best(self, name, metric):
+        if not self.is_better(metric):
+            return
+        if not os.path.exists(os.path.join(self.save_dir, name)):
+            print("checkpoint [%s] (metric %.6f) was already rotated out" % (name, metric))
+            return
+        previous_best = self.best_name
+        self.best_name, self.best_metric = name, metric
+        # the previous best was only kept for being the best
+        if previous_best is not None and previous_best != name and previous_best not in self.recent:
+            self.remove(previous_best)
+        atomic_save_json({"name": name, "metric": metric, "mode": self.metric_mode},
+                         os.path.join(self.save_dir, BEST_RECORD_NAME))
+        print("new best checkpoint [%s] metric %.6f" % (name, metric))
+
+    def rotate(self):
+        if not self.keep_last:
+            return
+        while len(self.recent) > self.keep_last:
+            old_name = self.recent.pop(0)
+            if old_name != self.best_name:
+                self.remove(old_name)
+
+    def remove(self, name):
+        path = os.path.join(self.save_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def flush(self):
+        """
+        wait until every queued checkpoint is on disk.
+        """
+        if self.thread is not None:
+            self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise Exception("checkpoint writing failed: %s" % error)
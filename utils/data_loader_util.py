@@ -3,87 +3,130 @@ import torch.nn.functional as F
 import numpy as np
 import os
 import glob
+from utils import CompositeDatasetFolder
+from utils import dist_util
 from utils import ProcessedDatasetFolder
 from utils import ProcessedDatasetFolderImg
 from utils import hdr_image_util
+from utils import lambda_index
 from utils import params
 from utils import printer
 
 
-def load_data_set(data_root, dataset_properties, shuffle, hdrMode, ldrNegMode):
+def get_data_loader(npy_dataset, dataset_properties, shuffle, num_workers=None, sampler=None):
+    """
+    samples are built on the cpu by "num_workers" worker processes (default from dataset_properties),
+    pinned when running on gpu and moved to the device by the trainer with non_blocking copies.
+    """
+    if num_workers is None:
+        num_workers = dataset_properties["num_workers"]
+    pin_memory = bool(dataset_properties["pin_memory"]) and torch.cuda.is_available()
+    workers_args = {}
+    if num_workers > 0:
+        workers_args["prefetch_factor"] = dataset_properties["prefetch_factor"]
+        workers_args["persistent_workers"] = True
+    return torch.utils.data.DataLoader(npy_dataset, batch_size=dataset_properties["batch_size"],
+                                       shuffle=shuffle, sampler=sampler, num_workers=num_workers,
+                                       pin_memory=pin_memory, **workers_args)
+
+
+def load_data_set(data_root, dataset_properties, shuffle, hdrMode, ldrNegMode, num_workers=None):
     npy_dataset = ProcessedDatasetFolder.ProcessedDatasetFolder(root=data_root,
                                                                 dataset_properties=dataset_properties,
                                                                 hdrMode=hdrMode,
                                                                 ldrNegMode=ldrNegMode)
     #dataloader = torch.utils.data.DataLoader(npy_dataset, batch_size=dataset_properties["batch_size"],
     #                                         shuffle=shuffle, num_workers=params.workers, pin_memory=True)
-    dataloader = torch.utils.data.DataLoader(npy_dataset, batch_size=dataset_properties["batch_size"],
-                                             shuffle=shuffle, num_workers=0, pin_memory=False)
+    dataloader = get_data_loader(npy_dataset, dataset_properties, shuffle, num_workers)
     return dataloader
 
-def load_image_data_set(data_root, dataset_properties, shuffle, hdrMode, ldrNegMode):
+def load_image_data_set(data_root, dataset_properties, shuffle, hdrMode, ldrNegMode, num_workers=None):
     npy_dataset = ProcessedDatasetFolderImg.ProcessedDatasetFolder(root=data_root,
                                                                 dataset_properties=dataset_properties,
                                                                 hdrMode=hdrMode,
                                                                 ldrNegMode=ldrNegMode)
     #dataloader = torch.utils.data.DataLoader(npy_dataset, batch_size=dataset_properties["batch_size"],
     #                                         shuffle=shuffle, num_workers=params.workers, pin_memory=True)
-    dataloader = torch.utils.data.DataLoader(npy_dataset, batch_size=dataset_properties["batch_size"],
-                                             shuffle=shuffle, num_workers=0, pin_memory=False)
+    dataloader = get_data_loader(npy_dataset, dataset_properties, shuffle, num_workers)
     return dataloader
 
-
-def load_train_data(dataset_properties, title):
+def get_train_data_sets(dataset_properties, image_mode):
     """
-    :return: DataLoader object of images in "train_root_ldr"
+    :return: hdr, ldr positive and ldr negative train datasets,
+             read from the packed shards when "train_shards_dir" is set,
+             or streamed from the original image files when "train_stream" is set
     """
+    modes = [(True, False), (False, False), (False, True)]
+    if dataset_properties["train_shards_dir"]:
+        # imported here, ShardedDatasetFolder subclasses the dataset modules that import this one
+        from utils import ShardedDatasetFolder
+        shards_dir = dataset_properties["train_shards_dir"]
+        print("loading train data from shards in ", shards_dir)
+        if image_mode:
+            dataset_class = ShardedDatasetFolder.ShardedDatasetFolderImg
+        else:
+            dataset_class = ShardedDatasetFolder.ShardedDatasetFolder
+        return [dataset_class(shards_dir=shards_dir, dataset_properties=dataset_properties,
+                              hdrMode=hdrMode, ldrNegMode=ldrNegMode) for hdrMode, ldrNegMode in modes]
+    if dataset_properties["train_stream"]:
+        # imported here for the same reason as ShardedDatasetFolder
+        from utils import StreamingDatasetFolder
+        print("streaming train images from ", dataset_properties["train_root_npy"], dataset_properties["train_root_ldr"])
+        stream_store = StreamingDatasetFolder.StreamStore(image_size=dataset_properties["stream_image_size"],
+                                                          cache_mb=dataset_properties["stream_cache_mb"],
+                                                          threads=dataset_properties["stream_threads"])
+        train_root_hdr = StreamingDatasetFolder.list_source_files(dataset_properties["train_root_npy"],
+                                                                  StreamingDatasetFolder.HDR_EXTENSIONS + ('.npy',))
+        train_root_ldr = StreamingDatasetFolder.list_source_files(dataset_properties["train_root_ldr"],
+                                                                  StreamingDatasetFolder.LDR_EXTENSIONS + ('.npy',))
+        if image_mode:
+            dataset_class = StreamingDatasetFolder.StreamingDatasetFolderImg
+        else:
+            dataset_class = StreamingDatasetFolder.StreamingDatasetFolder
+        roots = [train_root_hdr, train_root_ldr, train_root_ldr]
+        return [dataset_class(root=root, dataset_properties=dataset_properties, hdrMode=hdrMode,
+                              ldrNegMode=ldrNegMode, stream_store=stream_store)
+                for root, (hdrMode, ldrNegMode) in zip(roots, modes)]
     print("loading hdr train data from ", dataset_properties["train_root_npy"])
     train_root_npy = glob.glob(dataset_properties["train_root_npy"]+'/*.npy')
     train_root_ldr = glob.glob(dataset_properties["train_root_ldr"]+'/*.npy')
-    #train_hdr_dataloader = load_data_set(dataset_properties["train_root_npy"], dataset_properties,
-    #                                     shuffle=True, hdrMode=True)
-    #train_ldr_dataloader = load_data_set(dataset_properties["train_root_ldr"], dataset_properties,
-    #                                     shuffle=True, hdrMode=False)
-    train_hdr_dataloader = load_data_set(train_root_npy, dataset_properties,
-                                         shuffle=True, hdrMode=True, ldrNegMode=False)
-    train_ldr_pos_dataloader = load_data_set(train_root_ldr, dataset_properties,
-                                         shuffle=True, hdrMode=False, ldrNegMode=False)
-    train_ldr_neg_dataloader = load_data_set(train_root_ldr, dataset_properties,
-                                         shuffle=True, hdrMode=False, ldrNegMode=True)
+    if image_mode:
+        dataset_class = ProcessedDatasetFolderImg.ProcessedDatasetFolder
+    else:
+        dataset_class = ProcessedDatasetFolder.ProcessedDatasetFolder
+    roots = [train_root_npy, train_root_ldr, train_root_ldr]
+    return [dataset_class(root=root, dataset_properties=dataset_properties, hdrMode=hdrMode, ldrNegMode=ldrNegMode)
+            for root, (hdrMode, ldrNegMode) in zip(roots, modes)]
 
-    #printer.print_dataset_details([train_hdr_dataloader, train_ldr_dataloader],
-    #                              [dataset_properties["train_root_npy"], dataset_properties["train_root_ldr"]],
-    #                              [title + "_hdr_dataloader", title + "_ldr_dataloader"],
-    #                              [True, False],
-    #                              [True, True])
-    #printer.load_data_dict_mode(train_hdr_dataloader, train_ldr_dataloader, title, images_number=2)
-    return train_hdr_dataloader, train_ldr_pos_dataloader, train_ldr_neg_dataloader
 
-def load_train_image_data(dataset_properties, title):
+def load_train_triplets(dataset_properties, image_mode):
     """
-    :return: DataLoader object of images in "train_root_ldr"
+    :return: one DataLoader of {"hdr", "ldr_pos", "ldr_neg"} batches,
+             the three sets are sampled by TripletSampler according to "sampling_ratios"
     """
-    print("loading hdr train data from ", dataset_properties["train_root_npy"])
-    train_root_npy = glob.glob(dataset_properties["train_root_npy"]+'/*.npy')
-    train_root_ldr = glob.glob(dataset_properties["train_root_ldr"]+'/*.npy')
-    #train_hdr_dataloader = load_data_set(dataset_properties["train_root_npy"], dataset_properties,
-    #                                     shuffle=True, hdrMode=True)
-    #train_ldr_dataloader = load_data_set(dataset_properties["train_root_ldr"], dataset_properties,
-    #                                     shuffle=True, hdrMode=False)
-    train_hdr_dataloader = load_image_data_set(train_root_npy, dataset_properties,
-                                         shuffle=True, hdrMode=True, ldrNegMode=False)
-    train_ldr_pos_dataloader = load_image_data_set(train_root_ldr, dataset_properties,
-                                         shuffle=True, hdrMode=False, ldrNegMode=False)
-    train_ldr_neg_dataloader = load_image_data_set(train_root_ldr, dataset_properties,
-                                         shuffle=True, hdrMode=False, ldrNegMode=True)
+    hdr_dataset, ldr_pos_dataset, ldr_neg_dataset = get_train_data_sets(dataset_properties, image_mode)
+    train_dataset = CompositeDatasetFolder.CompositeDatasetFolder(hdr_dataset, ldr_pos_dataset, ldr_neg_dataset)
+    sampler = CompositeDatasetFolder.TripletSampler(train_dataset.get_lengths(), dataset_properties["sampling_ratios"],
+                                                    num_replicas=dist_util.get_world_size(),
+                                                    rank=dist_util.get_rank(),
+                                                    seed=dataset_properties.get("seed", 0))
+    print("train sets sizes (hdr, ldr_pos, ldr_neg) %s, %d samples per epoch per process"
+          % (str(train_dataset.get_lengths()), len(sampler)))
+    return get_data_loader(train_dataset, dataset_properties, shuffle=False, sampler=sampler)
 
-    #printer.print_dataset_details([train_hdr_dataloader, train_ldr_dataloader],
-    #                              [dataset_properties["train_root_npy"], dataset_properties["train_root_ldr"]],
-    #                              [title + "_hdr_dataloader", title + "_ldr_dataloader"],
-    #                              [True, False],
-    #                              [True, True])
-    #printer.load_data_dict_mode(train_hdr_dataloader, train_ldr_dataloader, title, images_number=2)
-    return train_hdr_dataloader, train_ldr_pos_dataloader, train_ldr_neg_dataloader
+
+def load_train_data(dataset_properties, title):
+    """
+    :return: DataLoader of the video train triplets
+    """
+    return load_train_triplets(dataset_properties, image_mode=False)
+
+
+def load_train_image_data(dataset_properties, title):
+    """
+    :return: DataLoader of the image train triplets
+    """
+    return load_train_triplets(dataset_properties, image_mode=True)
 
 
 def load_test_data(dataset_properties, title):
@@ -99,10 +142,13 @@ def load_test_data(dataset_properties, title):
     #                                     shuffle=True, hdrMode=True)
     #train_ldr_dataloader = load_data_set(dataset_properties["test_dataroot_ldr"], dataset_properties,
     #                                     shuffle=True, hdrMode=False)
+    # the tester reads ready samples, batch_augment is only applied in the train loop
+    dataset_properties = dict(dataset_properties, batch_augment=0)
+    # a single batch is drawn per test call (next(iter(...))), so worker processes would only add start-up time
     train_hdr_dataloader = load_data_set(train_root_npy, dataset_properties,
-                                         shuffle=True, hdrMode=True, ldrNegMode=False)
+                                         shuffle=True, hdrMode=True, ldrNegMode=False, num_workers=0)
     train_ldr_dataloader = load_data_set(train_root_ldr, dataset_properties,
-                                         shuffle=True, hdrMode=False, ldrNegMode=False)
+                                         shuffle=True, hdrMode=False, ldrNegMode=False, num_workers=0)
     #printer.print_dataset_details([train_hdr_dataloader, train_ldr_dataloader],
     #                              [dataset_properties["test_dataroot_npy"], dataset_properties["test_dataroot_ldr"]],
     #                              [title + "_hdr_dataloader", title + "_ldr_dataloader"],
@@ -211,12 +257,8 @@ def hdr_preprocess(im_path, factor_coeff, train_reshape, f_factor_path, data_trc
 
 def get_f(factor_coeff, f_factor_path, im_name):
     if f_factor_path != "none":
-        data = np.load(f_factor_path, allow_pickle=True)
-        if im_name in data[()]:
-            f_factor = data[()][im_name]
-            print("[%s] found in dict [%.4f]" % (im_name, f_factor))
-            return f_factor * 255 * factor_coeff
-        else:
-            raise Exception("no lambda found for file {} in {}".format(im_name, f_factor_path))
+        f_factor = lambda_index.get_lambda(f_factor_path, im_name)
+        print("[%s] found in dict [%.4f]" % (im_name, f_factor))
+        return f_factor * 255 * factor_coeff
     else:
         raise Exception("please provide valid path to lambdas")
\ No newline at end of file
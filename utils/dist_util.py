@@ -0,0 +1,95 @@
+import contextlib
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(backend=""):
+    """
+    join the process group described by the torchrun / torch.distributed.launch environment
+    (RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR, MASTER_PORT).
+    :param backend: nccl / gloo, "" picks nccl on gpus and gloo on cpu
+    :return: the device of this process
+    """
+    if "RANK" not in os.environ or "WORLD_SIZE" not in os.environ:
+        raise Exception("distributed training needs RANK and WORLD_SIZE, start it with torchrun")
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    use_cuda = torch.cuda.is_available() and torch.cuda.device_count() > 0
+    if not backend:
+        backend = "nccl" if use_cuda else "gloo"
+    if use_cuda:
+        device = torch.device("cuda", local_rank)
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device("cpu")
+    dist.init_process_group(backend=backend)
+    print("process [%d/%d] local rank %d on %s, %s backend"
+          % (get_rank(), get_world_size(), local_rank, str(device), backend))
+    return device
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_object(obj):
+    """
+    :return: the "obj" of rank 0 on every process (picklable objects)
+    """
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+@contextlib.contextmanager
+def main_process_first():
+    """
+    the main process runs the block (e.g. creates the output folders) before the others.
+    """
+    if not is_main_process():
+        barrier()
+    yield
+    if is_main_process():
+        barrier()
+
+
+def unwrap(net):
+    """
+    the model inside a DataParallel / DistributedDataParallel wrapper
+    """
+    return net.module if hasattr(net, "module") else net
+
+
+def no_sync(net):
+    """
+    context for a forward / backward of "net" that must not all-reduce its gradients
+    (DistributedDataParallel expects every forward with grad to be followed by exactly one backward)
+    """
+    if isinstance(net, torch.nn.parallel.DistributedDataParallel):
+        return net.no_sync()
+    return contextlib.nullcontext()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
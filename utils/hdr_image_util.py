@@ -34,7 +34,7 @@ def print_tensor_details(im, title):
 # ==========================
 def read_hdr_image(path):
     path_lib_path = pathlib.Path(path)
-    file_extension = os.path.splitext(path)[1]
+    file_extension = os.path.splitext(path)[1].lower()
     if file_extension == ".hdr":
         im = imageio.imread(path_lib_path, format="HDR-FI").astype('float32')
         #im = imageio.imread(path_lib_path).astype('float32')
@@ -0,0 +1,105 @@
+import os
+import sys
+
+import numpy as np
+
+# process-wide cache of loaded lambda tables, keyed by the path they were requested with.
+# the tables are built before the DataLoader workers are forked, so every worker reads the same pages.
+_lambda_indexes = {}
+
+
+class LambdaIndex:
+    """
+    read-only lookup table of lambda (f-factor) values, keyed by image / scene name.
+    keys and values are kept in two flat numpy arrays (keys sorted) instead of a python dict,
+    so forked workers share them without copy-on-write refcount churn.
+    """
+
+    def __init__(self, keys, values):
+        order = np.argsort(keys)
+        self.keys = np.asarray(keys)[order]
+        self.values = np.asarray(values, dtype=np.float64)[order]
+        self.keys.flags.writeable = False
+        self.values.flags.writeable = False
+
+    def _find(self, key):
+        i = int(np.searchsorted(self.keys, key))
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return -1
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        return float(self.values[i])
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def get_index_path(dict_path):
+    return os.path.splitext(dict_path)[0] + "_index.npz"
+
+
+def load_lambda_dict(dict_path):
+    data = np.load(dict_path, allow_pickle=True)[()]
+    keys = np.array([str(k) for k in data.keys()])
+    values = np.array([data[k] for k in data.keys()], dtype=np.float64)
+    return LambdaIndex(keys, values)
+
+
+def build_lambda_index(dict_path, output_path=None):
+    """
+    convert a pickled {name: lambda} .npy dict into the compact index format (.npz, no pickle).
+    :return: path of the written index
+    """
+    if output_path is None:
+        output_path = get_index_path(dict_path)
+    index = load_lambda_dict(dict_path)
+    np.savez(output_path, keys=index.keys, values=index.values)
+    print("lambda index for [%s] saved to [%s] (%d entries)" % (dict_path, output_path, len(index)))
+    return output_path
+
+
+def open_lambda_index(path):
+    if os.path.splitext(path)[1] == ".npz":
+        data = np.load(path)
+        return LambdaIndex(data["keys"], data["values"])
+    index_path = get_index_path(path)
+    if os.path.isfile(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(path):
+        data = np.load(index_path)
+        return LambdaIndex(data["keys"], data["values"])
+    return load_lambda_dict(path)
+
+
+def get_lambda_index(path):
+    """
+    return the lambda table of "path" (pickled .npy dict or built .npz index), loading it only once per process.
+    """
+    if path not in _lambda_indexes:
+        _lambda_indexes[path] = open_lambda_index(path)
+    return _lambda_indexes[path]
+
+
+def forget(path):
+    """
+    drop a cached table, needed after the .npy dict at "path" was rewritten (e.g. by adaptive_lambda).
+    """
+    _lambda_indexes.pop(path, None)
+
+
+def get_lambda(path, name):
+    index = get_lambda_index(path)
+    if name not in index:
+        raise Exception("no lambda found for file %s in %s" % (name, path))
+    return index[name]
+
+
+if __name__ == '__main__':
+    # usage: python utils/lambda_index.py data/input_images_lambdas_HDRplus256train.npy [...]
+    for dict_path in sys.argv[1:]:
+        build_lambda_index(dict_path)
@@ -0,0 +1,74 @@
+import os
+import sys
+
+import numpy as np
+
+CACHE_DIR_NAME = ".log_luma_cache"
+
+
+def get_cache_path(path, brightness_factor):
+    """
+    the derived maps of "path" are stored in a hidden folder next to it, keyed by the exact brightness factor
+    (lambda * 255 * factor_coeff, as float.hex), so a changed lambda file or factor_coeff maps to another cache file.
+    """
+    im_name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(os.path.dirname(path), CACHE_DIR_NAME, "%s_f%s.npy" % (im_name, float(brightness_factor).hex()))
+
+
+def compute_log_luma(color_im, brightness_factor):
+    """
+    :return: (h, w, 2) float32, channel 0 is the gray image, channel 1 the log10(x * f + 1) mapping of it
+             (x is the gray image shifted to 0 and divided by its max, over the whole source patch)
+    """
+    color_im = np.asarray(color_im, dtype=np.float32)
+    gray_im = 0.299 * color_im[:, :, 0] + 0.587 * color_im[:, :, 1] + 0.114 * color_im[:, :, 2]
+    gray_shift = gray_im - gray_im.min()
+    log_im = np.log10((gray_shift / gray_shift.max()) * brightness_factor + 1)
+    return np.stack([gray_im, log_im], axis=-1).astype(np.float32)
+
+
+def load_log_luma(path, color_im, brightness_factor):
+    """
+    return the derived maps of the source patch at "path" (whose pixels are "color_im"),
+    computing and saving them if the cache file is missing or older than the source.
+    """
+    cache_path = get_cache_path(path, brightness_factor)
+    try:
+        if os.path.getmtime(cache_path) >= os.path.getmtime(path):
+            return np.load(cache_path, mmap_mode='r')
+    except (OSError, ValueError):
+        # missing, removed meanwhile (remove_caches) or half written by an older version: rebuilt below
+        pass
+    maps = compute_log_luma(color_im, brightness_factor)
+    try:
+        if not os.path.exists(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # several workers can build the same file, write it under a private name and rename
+        tmp_path = "%s.%d.tmp.npy" % (cache_path[:-len(".npy")], os.getpid())
+        np.save(tmp_path, maps)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print("could not save log luma cache %s: %s" % (cache_path, e))
+    return maps
+
+
+def remove_caches(root):
+    """
+    remove the cached maps of the npy patches in "root", of every brightness factor.
+    files of old factors are not removed during training, another run on the same folder may still use them.
+    """
+    cache_dir = os.path.join(root, CACHE_DIR_NAME)
+    if not os.path.isdir(cache_dir):
+        return 0
+    names = os.listdir(cache_dir)
+    for name in names:
+        os.remove(os.path.join(cache_dir, name))
+    os.rmdir(cache_dir)
+    print("removed %d log luma cache files from [%s]" % (len(names), cache_dir))
+    return len(names)
+
+
+if __name__ == '__main__':
+    # usage: python utils/log_luma_cache.py data/hdr_data/train [...]
+    for root in sys.argv[1:]:
+        remove_caches(root)
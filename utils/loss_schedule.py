@@ -0,0 +1,84 @@
+import json
+import os
+
+# generator adversarial terms, see GanTrainer.update_g_d_loss
+LOSS_TERMS = ["contrastive_d", "nce_input", "nce_neg", "nce2", "mean_l1", "contrast_l1", "pseudo_label", "tv"]
+
+# last epoch of every phase but the final one
+DEFAULT_PHASE_EPOCHS = "6,9"
+# "term:w1,w2,w3;..." one weight per phase, before loss_g_d_factor
+DEFAULT_LOSS_SCHEDULE = ("contrastive_d:1,1e-6,1e-6;"
+                         "nce_input:0.5,0.5,0;"
+                         "nce_neg:0.1,0.1,0;"
+                         "nce2:1e-6,0.5,0;"
+                         "mean_l1:1e-6,50,50;"
+                         "contrast_l1:1e-6,1,0;"
+                         "pseudo_label:1e-6,1e-6,50;"
+                         "tv:0,0,2e4")
+
+
+def parse_schedule(schedule):
+    """
+    :param schedule: "term:w1,w2,...;term:..." or the path of a json file {term: [w1, w2, ...]}
+    :return: {term: [weight of every phase]}, missing terms have weight 0
+    """
+    if schedule.endswith(".json"):
+        if not os.path.isfile(schedule):
+            raise Exception("loss schedule file %s not found" % schedule)
+        with open(schedule) as f:
+            weights = {term: [float(w) for w in term_weights] for term, term_weights in json.load(f).items()}
+    else:
+        weights = {}
+        for item in schedule.split(';'):
+            if not item.strip():
+                continue
+            term, term_weights = item.split(':')
+            weights[term.strip()] = [float(w) for w in term_weights.split(',')]
+    for term in weights:
+        if term not in LOSS_TERMS:
+            raise Exception("unknown loss term %s in the loss schedule, use one of %s" % (term, str(LOSS_TERMS)))
+    return weights
+
+
+class LossSchedule:
+    """
+    per-phase weights of the generator adversarial terms.
+    phase i runs until epoch phase_epochs[i] (included), the last phase until the end of the training.
+    terms whose weight is below skip_threshold are not evaluated at all.
+    """
+
+    def __init__(self, schedule=DEFAULT_LOSS_SCHEDULE, phase_epochs=DEFAULT_PHASE_EPOCHS, skip_threshold=0):
+        self.phase_epochs = [int(e) for e in phase_epochs.split(',') if e.strip()]
+        self.num_phases = len(self.phase_epochs) + 1
+        self.weights = parse_schedule(schedule)
+        for term, term_weights in self.weights.items():
+            if len(term_weights) != self.num_phases:
+                raise Exception("loss term %s has %d weights, the schedule has %d phases"
+                                % (term, len(term_weights), self.num_phases))
+        self.skip_threshold = skip_threshold
+
+    def get_phase(self, epoch):
+        return sum(1 for last_epoch in self.phase_epochs if epoch > last_epoch)
+
+    def get_weight(self, term, epoch):
+        if term not in self.weights:
+            return 0.
+        return self.weights[term][self.get_phase(epoch)]
+
+    def get_active_terms(self, epoch):
+        """
+        :return: [(term, weight)] of the terms to evaluate at "epoch", in LOSS_TERMS order
+        """
+        active_terms = []
+        for term in LOSS_TERMS:
+            weight = self.get_weight(term, epoch)
+            if weight != 0 and abs(weight) >= self.skip_threshold:
+                active_terms.append((term, weight))
+        return active_terms
+
+    def __str__(self):
+        lines = ["loss schedule, phases end at epochs %s:" % str(self.phase_epochs)]
+        for term in LOSS_TERMS:
+            if term in self.weights:
+                lines.append("  %s: %s" % (term, ", ".join("%g" % w for w in self.weights[term])))
+        return "\n".join(lines)
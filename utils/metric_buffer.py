@@ -0,0 +1,97 @@
+import csv
+import os
+
+import numpy as np
+import torch
+
+
+class MetricBuffer:
+    """
+    per-step scalar metrics (the train losses) kept as device tensors in a fixed size ring of "capacity" steps,
+    so logging a loss does not wait for the device (no .item() per step).
+    when the ring is full, or on flush(), its rows are copied to the host in one transfer and appended to the
+    csv file at "path" (columns: step, names...), which is the series read back by read_series.
+    a metric not updated in a step is nan in its row.
+    with path None (distributed ranks other than 0) the rows are dropped at flush.
+    """
+
+    def __init__(self, names, device, path=None, capacity=500):
+        self.names = list(names)
+        self.columns = {name: i for i, name in enumerate(self.names)}
+        self.device = device
+        self.path = path
+        self.capacity = capacity
+        self.buffer = torch.full((capacity, len(self.names)), float("nan"), device=device)
+        self.steps = [0] * capacity
+        self.row = 0
+
+    def update(self, name, value):
+        """
+        :param value: 0-dim tensor (copied on the device) or number
+        """
+        if torch.is_tensor(value):
+            value = value.detach().float()
+        self.buffer[self.row, self.columns[name]] = value
+
+    def step(self, step):
+        """
+        close the row of train step "step"
+        """
+        self.steps[self.row] = step
+        self.row += 1
+        if self.row == self.capacity:
+            self.flush()
+
+    def flush(self):
+        if self.row == 0:
+            return
+        rows = self.buffer[:self.row].cpu().numpy()
+        if self.path is not None:
+            write_header = not os.path.exists(self.path)
+            with open(self.path, "a", newline="") as f:
+                writer = csv.writer(f)
+                if write_header:
+                    writer.writerow(["step"] + self.names)
+                for step, row in zip(self.steps[:self.row], rows):
+                    writer.writerow([step] + ["%.8g" % v for v in row])
+        self.buffer.fill_(float("nan"))
+        self.row = 0
+
+    def truncate(self, last_step):
+        """
+        drop the rows of the steps after "last_step" from the file, they were written after the snapshot
+        a run is resumed from and will be trained again.
+        """
+        self.flush()
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path, newline="") as f:
+            rows = list(csv.reader(f))
+        kept = rows[:1] + [row for row in rows[1:] if row and int(row[0]) <= last_step]
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", newline="") as f:
+            csv.writer(f).writerows(kept)
+        os.replace(tmp_path, self.path)
+
+    def set_path(self, path):
+        """
+        write the next rows to another file (e.g. after the D pre-training)
+        """
+        self.flush()
+        self.path = path
+
+
+def read_series(path):
+    """
+    :return: {"step": int array, name: float array} of a MetricBuffer file, empty arrays if it does not exist yet
+    """
+    if not os.path.exists(path):
+        return {"step": np.zeros(0, dtype=np.int64)}
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = [row for row in reader if row]
+    values = np.array(rows, dtype=np.float64).reshape(len(rows), len(header))
+    series = {name: values[:, i] for i, name in enumerate(header)}
+    series["step"] = series["step"].astype(np.int64)
+    return series
@@ -16,7 +16,7 @@ import models.unet_multi_filters.Unet as Generator
 import models.unet_multi_filters.Unet_singleFrame as GeneratorImg
 import tranforms
 from models import Discriminator
-from utils import params, data_loader_util, hdr_image_util
+from utils import params, data_loader_util, dist_util, hdr_image_util, lambda_index
 import cv2
 
 
@@ -48,11 +48,6 @@ def weights_init_xavier(m):
 
 
 def set_parallel_net(net, device_, is_checkpoint, net_name, use_xaviar=False):
-    # Handle multi-gpu if desired
-    if (device_.type == 'cuda') and (torch.cuda.device_count() > 1):
-        print("Using [%d] GPUs" % torch.cuda.device_count())
-        net = nn.DataParallel(net, list(range(torch.cuda.device_count())))
-
     # Apply the weights_init function to randomly initialize all weights to mean=0, stdev=0.2.
     if not is_checkpoint:
         if use_xaviar:
@@ -60,12 +55,22 @@ def set_parallel_net(net, device_, is_checkpoint, net_name, use_xaviar=False):
         else:
             net.apply(weights_init)
         print("Weights for " + net_name + " were initialized successfully")
+
+    # one process per device when distributed, DDP broadcasts the weights of rank 0 to the others
+    if dist_util.is_distributed():
+        device_ids = [device_.index] if device_.type == 'cuda' else None
+        net = nn.parallel.DistributedDataParallel(net, device_ids=device_ids)
+        print("%s wrapped by DistributedDataParallel, %d processes" % (net_name, dist_util.get_world_size()))
+    # Handle multi-gpu if desired
+    elif (device_.type == 'cuda') and (torch.cuda.device_count() > 1):
+        print("Using [%d] GPUs" % torch.cuda.device_count())
+        net = nn.DataParallel(net, list(range(torch.cuda.device_count())))
     return net
 
 
 def create_G_net(model, device_, is_checkpoint, input_dim_, last_layer, filters, con_operator, unet_depth_,
                  add_frame, unet_norm, stretch_g, activation, use_xaviar, output_dim,
-                 g_doubleConvTranspose, bilinear, padding, convtranspose_kernel, up_mode):
+                 g_doubleConvTranspose, bilinear, padding, convtranspose_kernel, up_mode, checkpoint_mode="none"):
     layer_factor = get_layer_factor(con_operator)
     if model != params.unet_network:
         assert 0, "Unsupported g model request: {}".format(model)
@@ -75,7 +80,8 @@ def create_G_net(model, device_, is_checkpoint, input_dim_, last_layer, filters,
                              unet_norm=unet_norm, stretch_g=stretch_g,
                              activation=activation,
                              doubleConvTranspose=g_doubleConvTranspose, padding_mode=padding,
-                             convtranspose_kernel=convtranspose_kernel, up_mode=up_mode).to(device_)
+                             convtranspose_kernel=convtranspose_kernel, up_mode=up_mode,
+                             checkpoint_mode=checkpoint_mode).to(device_)
     return set_parallel_net(new_net, device_, is_checkpoint, "Generator", use_xaviar)
     
 def create_G_net2(model, device_, is_checkpoint, input_dim_, last_layer, filters, con_operator, unet_depth_,
@@ -118,17 +124,56 @@ def create_D_net(input_dim_, down_dim, device_, is_checkpoint, norm, use_xaviar,
     return set_parallel_net(new_net, device_, is_checkpoint, "Discriminator", use_xaviar)
 
 
-def save_model(path, epoch, epoch_iter, output_dir, netG, optimizerG, netD, optimizerD):
-    path = os.path.join(output_dir, path, "net_epoch" + str(epoch) + '_iter' + str(epoch_iter) + ".pth")
-    if not os.path.exists(os.path.dirname(path)):
-        os.makedirs(os.path.dirname(path))
-    torch.save({
+def get_checkpoint_name(epoch, epoch_iter):
+    return "net_epoch" + str(epoch) + '_iter' + str(epoch_iter) + ".pth"
+
+
+def get_checkpoint_state(epoch, netG, optimizerG, netD, optimizerD, train_state=None):
+    """
+    :param train_state: the rest of the trainer state a run is resumed with (GanTrainer.get_train_state)
+    """
+    state = {
         'epoch': epoch,
         'modelD_state_dict': netD.state_dict(),
         'modelG_state_dict': netG.state_dict(),
         'optimizerD_state_dict': optimizerD.state_dict(),
         'optimizerG_state_dict': optimizerG.state_dict(),
-    }, path)
+    }
+    if train_state is not None:
+        state['train_state'] = train_state
+    return state
+
+
+def create_train_nets(opt, image_mode, device_=None, is_checkpoint=None):
+    """
+    G and D of a training run, as configured by "opt" (see config.py).
+    :param image_mode: single frame generator (main_train_image.py) instead of the video one
+    """
+    if device_ is None:
+        device_ = opt.device
+    if is_checkpoint is None:
+        is_checkpoint = opt.checkpoint
+    g_args = (opt.model, device_, is_checkpoint, opt.input_dim, opt.last_layer,
+              opt.filters, opt.con_operator, opt.unet_depth, opt.add_frame,
+              opt.unet_norm, opt.stretch_g, opt.g_activation, opt.use_xaviar,
+              opt.output_dim, opt.g_doubleConvTranspose, opt.bilinear,
+              opt.padding, opt.convtranspose_kernel, opt.up_mode)
+    if image_mode:
+        net_G = create_G_net2(*g_args)
+    else:
+        # activation checkpointing is an option of the recurrent video generator
+        net_G = create_G_net(*g_args, checkpoint_mode=opt.g_checkpoint)
+    net_D = create_D_net(opt.output_dim, opt.d_down_dim, device_, is_checkpoint, opt.d_norm,
+                         opt.use_xaviar, opt.d_model, opt.d_nlayers, opt.d_last_activation,
+                         opt.num_D, opt.d_fully_connected, opt.simpleD_maxpool, opt.d_padding)
+    return net_G, net_D
+
+
+def save_model(path, epoch, epoch_iter, output_dir, netG, optimizerG, netD, optimizerD):
+    path = os.path.join(output_dir, path, get_checkpoint_name(epoch, epoch_iter))
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    torch.save(get_checkpoint_state(epoch, netG, optimizerG, netD, optimizerD), path)
 
 
 def save_discriminator_model(path, epoch, output_dir, netD, optimizerD):
@@ -202,8 +247,7 @@ def load_g_model(model_params, device, net_path):
 
 
 def load_inference(im_path, f_factor_path, factor_coeff, device):
-    data = np.load(f_factor_path, allow_pickle=True)[()]
-    f_factor = data[os.path.splitext(os.path.basename(im_path))[0]] * 255 * factor_coeff
+    f_factor = lambda_index.get_lambda(f_factor_path, os.path.splitext(os.path.basename(im_path))[0]) * 255 * factor_coeff
     rgb_img = hdr_image_util.read_hdr_image(im_path)
     rgb_img = hdr_image_util.reshape_image(rgb_img, train_reshape=False)
     rgb_img = tranforms.hdr_im_transform(rgb_img).to(device)
@@ -218,8 +262,7 @@ def load_inference(im_path, f_factor_path, factor_coeff, device):
 
 def load_inference2(im_path, f_factor_path, factor_coeff, device):
     print(f_factor_path)
-    data = np.load(f_factor_path, allow_pickle=True)[()]
-    f_factor = data[os.path.splitext(os.path.basename(im_path))[0]] * 255 * factor_coeff
+    f_factor = lambda_index.get_lambda(f_factor_path, os.path.splitext(os.path.basename(im_path))[0]) * 255 * factor_coeff
     rgb_img = hdr_image_util.read_hdr_image(im_path)
     #scale=1
     scale=4
@@ -243,9 +286,8 @@ def load_inference_testvideo(im_path, f_factor_path, factor_coeff, device):
     print(f_factor_path)
     #f_factor_path = "lambda_data/input_images_lambdas_HDRSdataset.npy"
     #f_factor_path = "lambda_data/input_images_lambdas_Kalantari13_1.npy"
-    data = np.load(f_factor_path, allow_pickle=True)[()]
     #f_factor = data[os.path.splitext(os.path.basename(im_path))[0]] * 255 * factor_coeff
-    f_factor = data[im_path.split('/')[-2]] * 255 * factor_coeff
+    f_factor = lambda_index.get_lambda(f_factor_path, im_path.split('/')[-2]) * 255 * factor_coeff
     rgb_img = hdr_image_util.read_hdr_image(im_path)
     print('-------------------')
     print(rgb_img.shape)
@@ -5,6 +5,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 import utils.hdr_image_util as hdr_image_util
+import utils.metric_buffer as metric_buffer
 
 
 def plot_general_losses(G_loss_d, G_loss_ssim, G_loss_sigma, loss_D_fake, loss_D_real, title, iters_n, path, use_g_d_loss,
@@ -32,6 +33,18 @@ def plot_general_losses(G_loss_d, G_loss_ssim, G_loss_sigma, loss_D_fake, loss_D
         plt.close()
 
 
+def plot_losses_series(series_path, title, path, use_g_d_loss, use_g_ssim_loss):
+    """
+    plot_general_losses of the loss series written by MetricBuffer (utils/metric_buffer.py) to "series_path"
+    """
+    series = metric_buffer.read_series(series_path)
+    iters_n = len(series["step"])
+    if iters_n == 0:
+        return
+    plot_general_losses(series.get("errG_d", []), series.get("errG_struct", []), [], [], [], title, iters_n, path,
+                        use_g_d_loss and "errG_d" in series, use_g_ssim_loss and "errG_struct" in series)
+
+
 def plot_discriminator_losses(loss_D_fake, loss_D_real, title, iters_n, path):
     plt.figure()
     plt.plot(range(iters_n), loss_D_fake, '-r', label='loss D fake')
@@ -0,0 +1,309 @@
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+
+MANIFEST_NAME = "manifest.json"
+SHARD_NAME = "shard_%03d.bin"
+# every array starts on this boundary inside its shard
+SHARD_ALIGNMENT = 4096
+
+# training groups and the directory layout they are read from.
+# video groups are stored as <scene>/<frame>.npy, the others as flat <name>.npy folders.
+IMAGE_GROUPS = ["hdr", "ldr", "neg"]
+VIDEO_GROUPS = ["hdr_video", "srgb_video"]
+
+# on-disk encodings of the packed arrays, decoded back to float32 by the loaders
+ENCODINGS = ["none", "float16", "log_luma_chroma"]
+LUMA_EPSILON = 1e-6
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+
+# ====== ENCODING ======
+def encode_log_luma_chroma(im):
+    """
+    rgb (h, w, 3) -> (h, w, 4) uint8: float16 log2 luminance in bytes 0-1, r and g chromaticity in bytes 2 and 3.
+    4 bytes a pixel instead of 12 for float32, and the relative precision does not depend on the hdr range.
+    negative values are clipped to 0.
+    """
+    im = np.maximum(im.astype(np.float32), 0)
+    luma = 0.299 * im[..., 0] + 0.587 * im[..., 1] + 0.114 * im[..., 2]
+    rgb_sum = im.sum(axis=-1) + LUMA_EPSILON
+    encoded = np.empty(im.shape[:2] + (4,), dtype=np.uint8)
+    encoded[..., 0:2] = np.log2(luma + LUMA_EPSILON).astype(np.float16)[..., None].view(np.uint8)
+    encoded[..., 2] = np.round(im[..., 0] / rgb_sum * 255).astype(np.uint8)
+    encoded[..., 3] = np.round(im[..., 1] / rgb_sum * 255).astype(np.uint8)
+    return encoded
+
+
+def decode_log_luma_chroma(encoded):
+    log_luma = np.ascontiguousarray(encoded[..., 0:2]).view(np.float16)[..., 0]
+    luma = np.exp2(log_luma.astype(np.float32)) - LUMA_EPSILON
+    luma = np.maximum(luma, 0)
+    r = encoded[..., 2].astype(np.float32) / 255
+    g = encoded[..., 3].astype(np.float32) / 255
+    b = np.maximum(1 - r - g, 0)
+    rgb_sum = luma / (0.299 * r + 0.587 * g + 0.114 * b + LUMA_EPSILON)
+    return np.stack([r * rgb_sum, g * rgb_sum, b * rgb_sum], axis=-1)
+
+
+def get_float16_scale(im):
+    """
+    power of two the array is divided by before the float16 cast, so its largest magnitude fits
+    the float16 range (65504) instead of becoming inf, 1 if it already fits.
+    a power of two only shifts the exponents, the stored significands are the ones of the unscaled array.
+    """
+    peak = float(np.abs(im).max()) if im.size else 0.
+    if not np.isfinite(peak):
+        raise Exception("array with inf / nan values can not be stored as float16")
+    if peak <= FLOAT16_MAX:
+        return 1.
+    return float(2 ** np.ceil(np.log2(peak / FLOAT16_MAX)))
+
+
+def encode(im, encoding, scale=1.):
+    if encoding == "float16":
+        if scale != 1:
+            im = im / scale
+        return im.astype(np.float16)
+    if encoding == "log_luma_chroma":
+        return encode_log_luma_chroma(im)
+    return im
+
+
+class EncodedArray:
+    """
+    log_luma_chroma array as seen by the loaders: it has the decoded shape, and slicing / astype
+    decode only the requested rows and columns to float32.
+    """
+
+    def __init__(self, encoded, shape):
+        self.encoded = encoded
+        self.shape = tuple(shape)
+
+    def __getitem__(self, key):
+        # the loaders always take every channel, the encoded channels are not the rgb ones
+        if isinstance(key, tuple) and len(key) == 3:
+            key = key[:2]
+        return decode_log_luma_chroma(self.encoded[key])
+
+    def astype(self, dtype):
+        return decode_log_luma_chroma(self.encoded).astype(dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        im = decode_log_luma_chroma(self.encoded)
+        if dtype is not None:
+            im = im.astype(dtype)
+        return im
+
+
+class ScaledArray:
+    """
+    float16 array stored divided by "scale" (see get_float16_scale) as seen by the loaders:
+    slicing / astype return the float32 values multiplied back.
+    """
+
+    def __init__(self, stored, scale):
+        self.stored = stored
+        self.scale = scale
+        self.shape = stored.shape
+
+    def __getitem__(self, key):
+        return self.stored[key].astype(np.float32) * self.scale
+
+    def astype(self, dtype):
+        return (self.stored.astype(np.float32) * self.scale).astype(dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        im = self.stored.astype(np.float32) * self.scale
+        if dtype is not None:
+            im = im.astype(dtype)
+        return im
+
+
+# ====== MANIFEST ======
+def get_manifest_path(shards_dir):
+    return os.path.join(shards_dir, MANIFEST_NAME)
+
+
+def load_manifest(shards_dir):
+    manifest_path = get_manifest_path(shards_dir)
+    if not os.path.isfile(manifest_path):
+        raise Exception("no shard manifest found in %s" % shards_dir)
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def get_frame_id(basename):
+    return int(os.path.splitext(basename)[0])
+
+
+def get_entry_key(group, path, is_video):
+    """
+    key of an array in the manifest, it keeps the file name (and the scene folder for video frames)
+    so the lambda lookup and the next-frame logic of the loaders work on keys as they did on paths.
+    """
+    basename = os.path.basename(path)
+    if is_video:
+        return "/".join([group, path.split('/')[-2], basename])
+    return "/".join([group, basename])
+
+
+class ShardStore:
+    """
+    read-only access to the arrays of a packed shards directory.
+    shards are memory mapped lazily, so every DataLoader worker maps them in its own process.
+    """
+
+    def __init__(self, shards_dir):
+        manifest = load_manifest(shards_dir)
+        self.shards_dir = shards_dir
+        self.shard_names = manifest["shards"]
+        self.groups = {}
+        self.entries = {}
+        for group, group_entries in manifest["groups"].items():
+            self.groups[group] = [entry["key"] for entry in group_entries]
+            for entry in group_entries:
+                self.entries[entry["key"]] = entry
+        self._shards = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get_keys(self, group):
+        return list(self.groups.get(group, []))
+
+    def get_shard(self, shard_id):
+        if shard_id not in self._shards:
+            shard_path = os.path.join(self.shards_dir, self.shard_names[shard_id])
+            self._shards[shard_id] = np.memmap(shard_path, dtype=np.uint8, mode='r')
+        return self._shards[shard_id]
+
+    def load(self, key):
+        """
+        :return: read-only view of the array stored under "key", nothing is copied (or decoded)
+                 until it is sliced / cast
+        """
+        entry = self.entries[key]
+        shard = self.get_shard(entry["shard"])
+        stored_shape = entry.get("stored_shape", entry["shape"])
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(stored_shape))
+        im = np.frombuffer(shard, dtype=dtype, count=count, offset=entry["offset"]).reshape(stored_shape)
+        if entry.get("encoding") == "log_luma_chroma":
+            return EncodedArray(im, entry["shape"])
+        if entry.get("scale", 1) != 1:
+            return ScaledArray(im, entry["scale"])
+        # float16 is turned back to float32 by the .astype(np.float32) of the loaders
+        return im
+
+
+# ====== PACKER ======
+def list_group_files(group, root):
+    if group in VIDEO_GROUPS:
+        files = glob.glob(os.path.join(root, "*", "*.npy"))
+        # frames of a scene are stored next to each other, in frame order
+        return sorted(files, key=lambda p: (p.split('/')[-2], get_frame_id(os.path.basename(p))))
+    return sorted(glob.glob(os.path.join(root, "*.npy")))
+
+
+class ShardWriter:
+    def __init__(self, output_dir, shard_size):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.shard_names = []
+        self.f = None
+        self.offset = 0
+
+    def open_next_shard(self):
+        if self.f is not None:
+            self.f.close()
+        self.shard_names.append(SHARD_NAME % len(self.shard_names))
+        self.f = open(os.path.join(self.output_dir, self.shard_names[-1]), "wb")
+        self.offset = 0
+
+    def write(self, im):
+        im = np.ascontiguousarray(im)
+        if self.f is None or (self.offset > 0 and self.offset + im.nbytes > self.shard_size):
+            self.open_next_shard()
+        padding = (-self.offset) % SHARD_ALIGNMENT
+        self.f.write(b"\0" * padding)
+        self.offset += padding
+        offset = self.offset
+        self.f.write(im.tobytes())
+        self.offset += im.nbytes
+        return len(self.shard_names) - 1, offset
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def pack_shards(group_roots, output_dir, shard_size_mb=2048, encoding="none"):
+    """
+    pack the .npy training files of every group in "group_roots" ({group: root dir}) into large
+    contiguous shard files, and write a manifest with the offset, shape, dtype, scene and frame of each array.
+    :param encoding: one of ENCODINGS, how the arrays are stored in the shards.
+                     float16 arrays beyond the float16 range are stored divided by a power of two,
+                     kept as "scale" in their manifest entry.
+    """
+    if encoding not in ENCODINGS:
+        raise Exception("unknown shard encoding %s, use one of %s" % (encoding, str(ENCODINGS)))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    writer = ShardWriter(output_dir, shard_size_mb * 1024 * 1024)
+    groups = {}
+    for group, root in group_roots.items():
+        is_video = group in VIDEO_GROUPS
+        files = list_group_files(group, root)
+        print("packing %d files of [%s] from %s" % (len(files), group, root))
+        group_entries = []
+        for path in files:
+            im = np.load(path, allow_pickle=True)
+            scale = get_float16_scale(im) if encoding == "float16" else 1.
+            encoded = encode(im, encoding, scale)
+            shard_id, offset = writer.write(encoded)
+            entry = {"key": get_entry_key(group, path, is_video),
+                     "shard": shard_id,
+                     "offset": offset,
+                     "shape": list(im.shape),
+                     "stored_shape": list(encoded.shape),
+                     "dtype": encoded.dtype.str,
+                     "encoding": encoding,
+                     "scale": scale}
+            if is_video:
+                entry["scene"] = path.split('/')[-2]
+                entry["frame"] = get_frame_id(os.path.basename(path))
+            group_entries.append(entry)
+        groups[group] = group_entries
+    writer.close()
+    manifest = {"shards": writer.shard_names, "encoding": encoding, "groups": groups}
+    if encoding == "float16":
+        # how values beyond 65504 were kept: stored values times the "scale" of their entry
+        manifest["float16_overflow"] = "scale"
+    with open(get_manifest_path(output_dir), "w") as f:
+        json.dump(manifest, f)
+    print("%d shards and manifest saved to [%s]" % (len(writer.shard_names), output_dir))
+    return output_dir
+
+
+if __name__ == '__main__':
+    # usage: python utils/shard_util.py --output_dir data/train_shards --hdr data/hdr_data/train --ldr data/ldr_data/train
+    #        --neg ../../data/tone_mapping/SICE_patches512_npy --hdr_video ../../data/tone_mapping/train_HDRvideo ...
+    parser = argparse.ArgumentParser(description="pack training .npy files into shards")
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--shard_size_mb", type=int, default=2048)
+    parser.add_argument("--encoding", type=str, default="none", help="|".join(ENCODINGS))
+    for group in IMAGE_GROUPS + VIDEO_GROUPS:
+        parser.add_argument("--" + group, type=str, default="")
+    args = parser.parse_args()
+    group_roots = {group: getattr(args, group) for group in IMAGE_GROUPS + VIDEO_GROUPS if getattr(args, group)}
+    pack_shards(group_roots, args.output_dir, args.shard_size_mb, args.encoding)
@@ -0,0 +1,173 @@
+import collections
+import contextlib
+import csv
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+REPORT_NAME = "step_profile"
+CSV_FIELDS = ["step", "phase", "count", "mean_ms", "p50_ms", "p90_ms", "max_ms", "total_s", "step_share"]
+
+
+class StepProfiler:
+    """
+    wall time of the phases of a train step (data fetch, h2d copy, D / G forward and backward, loss terms, ...).
+    every phase keeps its last "window" durations for the rolling statistics and its total over the run.
+    every report_every steps the statistics are written to <output_dir>/step_profile.json (overwritten)
+    and appended to <output_dir>/step_profile.csv.
+    phases can nest (e.g. tmqi inside a loss term), their time is then counted in both.
+    with sync, cuda is synchronized around every phase, so the time of the kernels is charged to the phase
+    that launched them instead of the next one that waits for the device (slower, only for profiling).
+    trace_steps > 0 records a torch.profiler trace of steps [trace_start, trace_start + trace_steps),
+    written for tensorboard / chrome://tracing to <output_dir>/trace.
+    """
+
+    def __init__(self, output_dir, report_every=0, window=100, sync=True, trace_start=0, trace_steps=0,
+                 device=None, rank=0):
+        self.output_dir = output_dir
+        self.report_every = report_every
+        self.window = window
+        self.sync = sync and device is not None and device.type == "cuda"
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.device = device
+        # the trace is started at the end of step trace_start - 1, the first step has none before it
+        if trace_steps and trace_start < 1:
+            raise Exception("the profiler trace starts at step 1 at the earliest, got %d" % trace_start)
+        self.enabled = bool(report_every) or bool(trace_steps)
+        self.suffix = "" if rank == 0 else "_rank%d" % rank
+        self.durations = collections.defaultdict(lambda: collections.deque(maxlen=self.window))
+        self.totals = collections.defaultdict(float)
+        self.counts = collections.defaultdict(int)
+        self.step_durations = collections.deque(maxlen=window)
+        self.num_steps = 0
+        self.step_start = None
+        self.trace = None
+        if self.enabled and not os.path.exists(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
+
+    def synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        self.synchronize()
+        start = time.perf_counter()
+        with torch.profiler.record_function(name):
+            yield
+        self.synchronize()
+        duration = time.perf_counter() - start
+        self.durations[name].append(duration)
+        self.totals[name] += duration
+        self.counts[name] += 1
+
+    def phase(self, name):
+        """
+        context timing the block as phase "name", a no-op when the profiler is disabled
+        """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.timed(name)
+
+    def iterate(self, iterable, name):
+        """
+        iterate "iterable" (e.g. a DataLoader), timing every fetch as phase "name"
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def step(self):
+        """
+        end of a train step: step time, trace window and periodic report
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.step_start is not None:
+            self.step_durations.append(now - self.step_start)
+        self.step_start = now
+        self.num_steps += 1
+        self.update_trace()
+        if self.report_every and self.num_steps % self.report_every == 0:
+            self.report()
+
+    def update_trace(self):
+        if not self.trace_steps:
+            return
+        if self.trace is None and self.num_steps == self.trace_start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device is not None and self.device.type == "cuda":
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            trace_dir = os.path.join(self.output_dir, "trace")
+            self.trace = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True,
+                                                on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir))
+            self.trace.start()
+            print("torch.profiler trace of steps %d-%d started"
+                  % (self.trace_start, self.trace_start + self.trace_steps - 1))
+        elif self.trace is not None and self.num_steps == self.trace_start + self.trace_steps:
+            self.stop_trace()
+
+    def stop_trace(self):
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+            print("torch.profiler trace written to %s" % os.path.join(self.output_dir, "trace"))
+
+    def get_stats(self):
+        """
+        :return: {phase: {"count", "mean_ms", "p50_ms", "p90_ms", "max_ms", "total_s", "step_share"}},
+                 the rolling statistics are over the last "window" calls of the phase,
+                 step_share is the part of the mean step time spent in the phase
+        """
+        mean_step = float(np.mean(self.step_durations)) if self.step_durations else 0.
+        stats = {}
+        for name, durations in self.durations.items():
+            durations_ms = np.array(durations) * 1000
+            # the calls per step, so a phase that runs twice a step is charged twice
+            calls_per_step = self.counts[name] / max(self.num_steps, 1)
+            stats[name] = {"count": self.counts[name],
+                           "mean_ms": float(durations_ms.mean()),
+                           "p50_ms": float(np.percentile(durations_ms, 50)),
+                           "p90_ms": float(np.percentile(durations_ms, 90)),
+                           "max_ms": float(durations_ms.max()),
+                           "total_s": self.totals[name],
+                           "step_share": float(durations_ms.mean() / 1000 * calls_per_step / mean_step)
+                           if mean_step else 0.}
+        return stats
+
+    def report(self):
+        stats = self.get_stats()
+        step_ms = float(np.mean(self.step_durations)) * 1000 if self.step_durations else 0.
+        json_path = os.path.join(self.output_dir, REPORT_NAME + self.suffix + ".json")
+        tmp_path = json_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"step": self.num_steps, "mean_step_ms": step_ms, "window": self.window,
+                       "sync": self.sync, "phases": stats}, f, indent=2)
+        os.replace(tmp_path, json_path)
+        csv_path = os.path.join(self.output_dir, REPORT_NAME + self.suffix + ".csv")
+        write_header = not os.path.exists(csv_path)
+        with open(csv_path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            if write_header:
+                writer.writeheader()
+            for name, phase_stats in stats.items():
+                writer.writerow(dict(phase_stats, step=self.num_steps, phase=name))
+        print("[profile] step %d, %.1f ms/step: %s"
+              % (self.num_steps, step_ms,
+                 ", ".join("%s %.1fms" % (name, s["mean_ms"])
+                           for name, s in sorted(stats.items(), key=lambda item: -item[1]["step_share"])[:6])))
+
+    def close(self):
+        self.stop_trace()
+        if self.enabled and self.num_steps:
+            self.report()